@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Envío masivo de alertas por Telegram respetando sus límites de velocidad.
+Los destinatarios de cada lote se encolan y un número fijo de tareas asyncio
+los despachan pasando por dos cubetas de tokens: una global para el bot y
+otra por chat. Cada destinatario tiene su propio estado de entrega.
+"""
+
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+
+# Límites publicados por Telegram: ~30 mensajes/s por bot y 1 mensaje/s por chat
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+# Envíos simultáneos como máximo
+SEND_CONCURRENCY = 8
+# Reintentos de un destinatario cuando Telegram responde 429 (retry_after)
+MAX_RETRIES = 3
+# Lotes cuyo estado se conserva en memoria
+MAX_BATCHES = 100
+# Cubetas por chat que se guardan antes de descartar las que están en reposo
+MAX_CHAT_BUCKETS = 10000
+
+# Estados de entrega de cada destinatario
+PENDING = 'pendiente'
+RETRYING = 'reintentando'
+SENT = 'enviado'
+FAILED = 'error'
+NO_CHAT = 'sin_chat'
+NOT_FOUND = 'no_encontrado'
+FINAL_STATES = (SENT, FAILED, NO_CHAT, NOT_FOUND)
+
+
+class TokenBucket:
+    """
+    Cubeta de tokens: rate tokens por segundo y hasta capacity acumulados.
+    acquire() reserva el siguiente token (el saldo puede quedar negativo) y
+    espera lo que falte, así que los que llegan antes salen antes.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        self._refill()
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+    def wait_time(self):
+        """Segundos que faltan para que haya un token libre (0 si ya lo hay)"""
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Retrasa los siguientes tokens seconds segundos (p. ej. tras un 429)"""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+    def idle(self):
+        self._refill()
+        return self._tokens >= self.capacity
+
+
+class AlertDispatcher:
+    """
+    Cola de envío de alertas. send es una corrutina send(chat_id, texto);
+    si lanza una excepción con atributo retry_after (TelegramRetryAfter de
+    aiogram) el destinatario se reintenta después de esa pausa.
+    """
+
+    def __init__(self, send, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE,
+                 concurrency=SEND_CONCURRENCY, max_retries=MAX_RETRIES):
+        self.send = send
+        self.chat_rate = chat_rate
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate)
+        self._chats = {}
+        self._batches = OrderedDict()
+        self._queue = None
+        self._workers = []
+        self._delayed = set()
+
+    def start(self):
+        """Arranca las tareas de envío en el event loop actual"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for handle in self._delayed:
+            handle.cancel()
+        self._delayed.clear()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def join(self):
+        """Espera a que se hayan procesado todos los envíos encolados"""
+        await self._queue.join()
+
+    def submit(self, deliveries, skipped=None):
+        """
+        Encola un lote. deliveries es una lista de (correo, chat_id, texto);
+        skipped, un dict {correo: estado} de destinatarios que no se envían
+        (NO_CHAT, NOT_FOUND). Devuelve el id del lote.
+        """
+        batch_id = uuid.uuid4().hex
+        recipients = {}
+        for email, status in (skipped or {}).items():
+            recipients[email] = {'estado': status, 'intentos': 0, 'mensaje': None}
+        for email, chat_id, _ in deliveries:
+            recipients[email] = {'estado': PENDING, 'intentos': 0, 'mensaje': None}
+        self._batches[batch_id] = {'creado': time.time(), 'destinatarios': recipients}
+        while len(self._batches) > MAX_BATCHES:
+            self._batches.popitem(last=False)
+        self._prune_chats()
+        for email, chat_id, text in deliveries:
+            self._queue.put_nowait((recipients[email], chat_id, text))
+        return batch_id
+
+    def status(self, batch_id):
+        """Estado del lote: conteo por estado y detalle por destinatario; None si no existe"""
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            return None
+        recipients = batch['destinatarios']
+        counts = {}
+        for entry in recipients.values():
+            counts[entry['estado']] = counts.get(entry['estado'], 0) + 1
+        return {
+            'lote': batch_id,
+            'total': len(recipients),
+            'terminado': all(e['estado'] in FINAL_STATES for e in recipients.values()),
+            'conteo': counts,
+            'destinatarios': [dict(entry, correo=email) for email, entry in recipients.items()],
+        }
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    def _prune_chats(self):
+        if len(self._chats) > MAX_CHAT_BUCKETS:
+            for chat_id in [c for c, bucket in self._chats.items() if bucket.idle()]:
+                del self._chats[chat_id]
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            delay = None
+            try:
+                delay = await self._deliver(*item)
+            except Exception as e:
+                item[0]['estado'], item[0]['mensaje'] = FAILED, str(e)
+            finally:
+                if delay:
+                    self._delay(delay, item)
+                else:
+                    self._queue.task_done()
+
+    def _delay(self, seconds, item):
+        # El envío vuelve a la cola pasados seconds segundos; hasta entonces
+        # sigue contando como pendiente para join()
+        def requeue():
+            self._delayed.discard(handle)
+            self._queue.put_nowait(item)
+            self._queue.task_done()
+
+        handle = asyncio.get_running_loop().call_later(seconds, requeue)
+        self._delayed.add(handle)
+
+    async def _deliver(self, entry, chat_id, text):
+        """Envía a un destinatario; devuelve los segundos a esperar si hay que reintentarlo"""
+        # Un chat en pausa (separación mínima o 429) no ocupa la tarea ni
+        # gasta token global: el envío se aplaza y la tarea atiende a otros
+        bucket = self._chat_bucket(chat_id)
+        wait = bucket.wait_time()
+        if wait > 0:
+            return wait
+        await self._global.acquire()
+        # Otro envío al mismo chat pudo tomar su turno durante la espera global
+        wait = bucket.wait_time()
+        if wait > 0:
+            return wait
+        await bucket.acquire()
+        entry['intentos'] += 1
+        try:
+            await self.send(chat_id, text)
+        except Exception as e:
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after is None or entry['intentos'] > self.max_retries:
+                entry['estado'], entry['mensaje'] = FAILED, str(e)
+                return None
+            # El 429 llega por chat; solo ese chat espera lo que pide Telegram
+            bucket.pause(retry_after)
+            entry['estado'], entry['mensaje'] = RETRYING, str(e)
+            return bucket.wait_time()
+        entry['estado'], entry['mensaje'] = SENT, None
+        return None
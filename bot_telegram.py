@@ -10,8 +10,8 @@ from aiogram.enums import ParseMode
 from aiohttp import web
 import requests
 import json
-import sqlite3
-import hashlib
+from database_manager import AsyncDatabaseManager
+from alert_dispatcher import AlertDispatcher, NO_CHAT, NOT_FOUND
 
 # --- CONFIGURACIÓN ---
 API_TOKEN = 'YOUR API KEY'
@@ -20,8 +20,10 @@ logging.basicConfig(level=logging.INFO)
 # URL del servidor web Flask
 WEB_SERVER_URL = "http://localhost:5000"
 
-# Base de datos SQLite
+# Base de datos SQLite (misma capa y pool que el servidor web). Las consultas
+# corren en hilos propios para no bloquear el event loop
 DB_NAME = "login_database.db"
+db = AsyncDatabaseManager(DB_NAME)
 
 # --- BASE DE DATOS SIMULADA ---
 # MODIFICADO: Añadimos un campo 'chat_id' para guardar la "dirección" del usuario
@@ -65,79 +67,25 @@ Contacta al administrador del sistema.
 
 # --- FUNCIONES DE VALIDACIÓN ---
 
-def hash_password(password):
-    """Genera hash seguro de la contraseña (igual que en database_manager.py)"""
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def save_user_chat_id(email: str, chat_id: int):
+async def save_user_chat_id(email: str, chat_id: int):
     """Guarda el chat_id del usuario en la base de datos SQLite"""
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Verificar si existe una tabla para chat_ids o agregar columna
-        cursor.execute("PRAGMA table_info(usuarios)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'chat_id' not in columns:
-            # Agregar columna chat_id si no existe
-            cursor.execute('ALTER TABLE usuarios ADD COLUMN chat_id INTEGER')
-            logging.info("Columna chat_id agregada a la tabla usuarios")
-        
-        # Actualizar chat_id del usuario
-        cursor.execute('''
-            UPDATE usuarios SET chat_id = ? WHERE correo = ?
-        ''', (chat_id, email))
-        
-        conn.commit()
-        conn.close()
-        
+    if await db.save_chat_id(email, chat_id):
         logging.info(f"Chat ID {chat_id} guardado para usuario {email}")
         return True
-        
-    except Exception as e:
-        logging.error(f"Error al guardar chat_id: {e}")
-        return False
+    logging.error(f"No se pudo guardar el chat_id de {email}")
+    return False
 
 async def validate_credentials(email: str, password: str):
-    """Valida credenciales contra la base de datos SQLite directamente"""
+    """Valida credenciales contra la base de datos SQLite"""
     try:
-        # Conectar a la base de datos SQLite
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Buscar usuario en la base de datos
-        cursor.execute('''
-            SELECT id, correo, contrasena_hash, activo FROM usuarios 
-            WHERE correo = ? AND activo = 1
-        ''', (email,))
-        
-        user = cursor.fetchone()
-        
-        if user:
-            user_id, user_email, stored_hash, is_active = user
-            
-            # Verificar contraseña
-            password_hash = hash_password(password)
-            if password_hash == stored_hash:
-                # Actualizar último acceso
-                cursor.execute('''
-                    UPDATE usuarios SET ultimo_acceso = CURRENT_TIMESTAMP 
-                    WHERE id = ?
-                ''', (user_id,))
-                conn.commit()
-                conn.close()
-                
-                logging.info(f"Usuario {email} autenticado exitosamente")
-                return True, user_email
-            else:
-                conn.close()
-                logging.warning(f"Contraseña incorrecta para {email}")
-                return False, None
-        else:
-            conn.close()
-            logging.warning(f"Usuario {email} no encontrado o inactivo")
-            return False, None
+        success, message, user_email = await db.login_user(email, password)
+        if success:
+            logging.info(f"Usuario {email} autenticado exitosamente")
+            return True, user_email
+        if message.startswith("Error"):
+            raise RuntimeError(message)
+        logging.warning(f"Credenciales inválidas o usuario inactivo: {email}")
+        return False, None
             
     except Exception as e:
         logging.error(f"Error al validar credenciales: {e}")
@@ -179,7 +127,7 @@ async def get_password(message: types.Message, state: FSMContext):
 
     if is_valid:
         # Guardar chat_id en la base de datos SQLite
-        save_user_chat_id(email, message.chat.id)
+        await save_user_chat_id(email, message.chat.id)
         
         # También guardar en base de datos local como respaldo
         if email in user_db:
@@ -236,21 +184,11 @@ async def handle_send_alert(request):
             return web.Response(text="Error: Email no proporcionado.", status=400)
         
         # Buscar usuario en la base de datos SQLite
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT chat_id, activo FROM usuarios 
-            WHERE correo = ? AND activo = 1
-        ''', (email,))
-        
-        user = cursor.fetchone()
-        conn.close()
+        found, chat_id = await db.get_chat_id(email)
         
-        if not user:
+        if not found:
             return web.Response(text=f"Error: Usuario {email} no encontrado o inactivo.", status=404)
         
-        chat_id = user[0]
         if not chat_id:
             return web.Response(text=f"Error: El usuario {email} no ha iniciado sesión en el bot.", status=400)
 
@@ -266,7 +204,8 @@ async def handle_send_alert(request):
             "risk_level": data.get("risk_level", "elevados"),
             "contaminants": data.get("contaminants", "no especificados")
         }
-        recomendacion_texto = recomendacion.generar_precauciones(perfil, alteraciones)
+        # Sin bloquear el bot; si Gemini tarda o falla llega la plantilla
+        recomendacion_texto = await recomendacion.generar_precauciones_async(perfil, alteraciones)
         # Enviar la recomendación generada por Gemini
         await bot.send_message(chat_id, recomendacion_texto, parse_mode=ParseMode.HTML)
         logging.info(f"Recomendación enviada a {email} en el chat_id {chat_id}")
@@ -276,6 +215,66 @@ async def handle_send_alert(request):
         logging.error(f"Error al procesar la alerta: {e}")
         return web.Response(text=f"Error interno del servidor: {e}", status=500)
 
+async def send_alert_message(chat_id, text):
+    await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
+
+# Cola de envíos masivos con los límites de velocidad de Telegram
+dispatcher = AlertDispatcher(send_alert_message)
+
+async def handle_send_alert_batch(request):
+    """
+    Envío masivo. Espera un JSON con "emails" (lista de correos) o
+    "selector": "todos" (todos los usuarios activos con chat_id), más zone,
+    risk_level, contaminants y tipo_usuario. Responde 202 con el id del lote;
+    el estado por destinatario se consulta en /send_alert_batch/{id}.
+    """
+    try:
+        data = await request.json()
+    except Exception:
+        return web.json_response({"error": "JSON inválido"}, status=400)
+    if not isinstance(data, dict):
+        return web.json_response({"error": "Se esperaba un objeto JSON"}, status=400)
+    
+    emails = data.get("emails")
+    if data.get("selector") == "todos":
+        chat_ids = await db.get_chat_ids()
+        emails = list(chat_ids)
+    elif isinstance(emails, list) and emails and all(isinstance(e, str) for e in emails):
+        emails = list(dict.fromkeys(e.strip() for e in emails))
+        chat_ids = await db.get_chat_ids(emails)
+    else:
+        return web.json_response({"error": "Proporciona 'emails' (lista) o 'selector': 'todos'"}, status=400)
+    
+    # Una sola recomendación para todo el lote: las alteraciones son las mismas
+    import recomendacion
+    perfil = {"tipo_usuario": data.get("tipo_usuario", "persona")}
+    alteraciones = {
+        "zone": data.get("zone", "tu zona"),
+        "risk_level": data.get("risk_level", "elevados"),
+        "contaminants": data.get("contaminants", "no especificados")
+    }
+    recomendacion_texto = await recomendacion.generar_precauciones_async(perfil, alteraciones)
+    
+    deliveries, skipped = [], {}
+    for email in emails:
+        if email not in chat_ids:
+            skipped[email] = NOT_FOUND
+        elif not chat_ids[email]:
+            skipped[email] = NO_CHAT
+        else:
+            deliveries.append((email, chat_ids[email], recomendacion_texto))
+    
+    batch_id = dispatcher.submit(deliveries, skipped)
+    logging.info(f"Lote {batch_id}: {len(deliveries)} alertas encoladas, {len(skipped)} omitidas")
+    return web.json_response({"lote": batch_id, "encolados": len(deliveries),
+                              "omitidos": len(skipped)}, status=202)
+
+async def handle_alert_batch_status(request):
+    status = dispatcher.status(request.match_info["batch_id"])
+    if status is None:
+        return web.json_response({"error": "Lote no encontrado"}, status=404)
+    return web.json_response(status)
+
 # --- INICIO DEL BOT Y SERVIDOR ---
 async def main():
     dp = Dispatcher()
@@ -284,6 +283,12 @@ async def main():
     # Creamos la aplicación web
     app = web.Application()
     app.router.add_post('/send_alert', handle_send_alert)
+    app.router.add_post('/send_alert_batch', handle_send_alert_batch)
+    app.router.add_get('/send_alert_batch/{batch_id}', handle_alert_batch_status)
+    dispatcher.start()
+    # El modelo de Gemini se crea una vez al arrancar y fuera del event loop
+    import recomendacion
+    await recomendacion.cargar_modelo()
     
     # Iniciamos el servidor web y el bot
     runner = web.AppRunner(app)
@@ -292,7 +297,12 @@ async def main():
     await site.start()
     logging.info("Servidor web iniciado en http://localhost:8080")
     
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+        await dispatcher.stop()
+        await db.close()
 
 if __name__ == '__main__':
     try:
@@ -1,21 +1,73 @@
 import sqlite3
 import hashlib
 import os
-from datetime import datetime
+import queue
+import threading
+import csv
+import io
+import json
+import base64
+import time
+import atexit
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
 import re
+import pandas as pd
 
-class DatabaseManager:
-    def __init__(self, db_name="login_database.db"):
-        """Inicializa la conexión a la base de datos"""
-        self.db_name = db_name
-        self.init_database()
-    
-    def init_database(self):
-        """Crea la tabla de usuarios si no existe"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+# Conexiones abiertas como máximo por DatabaseManager
+POOL_SIZE = 8
+# Segundos que SQLite reintenta antes de responder "database is locked"
+BUSY_TIMEOUT = 5
+# Segundos que se espera una conexión libre cuando el pool está agotado
+POOL_TIMEOUT = 10
+# Sentencias preparadas que cada conexión conserva en caché
+STATEMENT_CACHE_SIZE = 128
+
+EMAIL_PATTERN = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+MIN_PASSWORD_LENGTH = 6
+
+# Filas por transacción en el registro masivo
+BULK_BATCH_SIZE = 5000
+
+# Entradas y segundos de vida de la caché de get_user_info. La invalidación
+# explícita solo alcanza al propio proceso; el TTL acota lo que otro proceso
+# (p. ej. el bot) puede tardar en ver un cambio
+USER_CACHE_SIZE = 4096
+USER_CACHE_TTL = 30
+
+# Los últimos accesos se acumulan en memoria y se escriben juntos cada
+# ACCESS_FLUSH_INTERVAL segundos o al juntar ACCESS_FLUSH_SIZE usuarios
+ACCESS_FLUSH_INTERVAL = 0.5
+ACCESS_FLUSH_SIZE = 500
+
+# Hilos dedicados a SQLite en AsyncDatabaseManager (el bot)
+ASYNC_DB_THREADS = 4
+
+# Tamaño de página por defecto y máximo del listado de usuarios
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Usuarios por página al recorrer el listado completo (exportaciones)
+STREAM_FETCH_SIZE = 1000
+
+
+
+def _add_chat_id_column(conn):
+    # Las bases creadas con versiones anteriores del bot ya pueden tenerla
+    columns = {column[1] for column in conn.execute("PRAGMA table_info(usuarios)")}
+    if 'chat_id' not in columns:
+        conn.execute('ALTER TABLE usuarios ADD COLUMN chat_id INTEGER')
+
+
+# Migraciones del esquema en orden: (descripción, sentencias SQL o función
+# que recibe la conexión). La versión de cada una es su posición (desde 1) y
+# se guarda en PRAGMA user_version. Solo se agregan al final, nunca se editan
+MIGRATIONS = [
+    ("Tabla de usuarios e índice por fecha de alta", [
+        '''
             CREATE TABLE IF NOT EXISTS usuarios (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 correo TEXT UNIQUE NOT NULL,
@@ -24,10 +76,260 @@ class DatabaseManager:
                 ultimo_acceso TIMESTAMP,
                 activo BOOLEAN DEFAULT 1
             )
-        ''')
+        ''',
+        # Para listar por fecha de alta sin ordenar la tabla completa
+        '''
+            CREATE INDEX IF NOT EXISTS idx_usuarios_fecha_creacion
+            ON usuarios (fecha_creacion DESC, id DESC)
+        ''',
+    ]),
+    ("Columna chat_id del bot de Telegram", _add_chat_id_column),
+    ("Índice por chat_id", [
+        'CREATE INDEX IF NOT EXISTS idx_usuarios_chat_id ON usuarios (chat_id)',
+    ]),
+    ("Índice por correo y estado", [
+        'CREATE INDEX IF NOT EXISTS idx_usuarios_correo_activo ON usuarios (correo, activo)',
+    ]),
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def encode_cursor(fecha_creacion, user_id):
+    """Cursor opaco con la posición (fecha_creacion, id) del último usuario entregado"""
+    raw = json.dumps([fecha_creacion, user_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverso de encode_cursor; ValueError si el cursor no es válido"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        fecha_creacion, user_id = json.loads(raw)
+    except Exception:
+        raise ValueError("Cursor inválido")
+    if not isinstance(fecha_creacion, str) or not isinstance(user_id, int):
+        raise ValueError("Cursor inválido")
+    return fecha_creacion, user_id
+
+
+def iter_user_records(stream, fmt='csv'):
+    """
+    Lee usuarios de un archivo CSV (columnas email/correo y password/contrasena)
+    o NDJSON (un objeto por línea) sin cargarlo completo en memoria
+    """
+    if isinstance(stream, (bytes, bytearray)):
+        stream = io.BytesIO(stream)
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig')
+    if fmt == 'ndjson':
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = {}
+            yield record if isinstance(record, dict) else {}
+    elif fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield {(k or '').strip().lower(): v for k, v in row.items()}
+    else:
+        raise ValueError("Formato no soportado (use csv o ndjson)")
+
+class DatabaseManager:
+    def __init__(self, db_name="login_database.db", pool_size=POOL_SIZE,
+                 cache_size=USER_CACHE_SIZE, cache_ttl=USER_CACHE_TTL):
+        """Inicializa el pool de conexiones a la base de datos"""
+        self.db_name = db_name
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._pool_lock = threading.Lock()
+        self._opened = 0
+        # LRU correo -> (expira, info) delante de get_user_info
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._user_cache = OrderedDict()
+        self._user_cache_lock = threading.Lock()
+        self._cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        # Cambia con cada invalidación: una lectura que se cruzó con una
+        # escritura no guarda en caché el valor que leyó
+        self._cache_generation = 0
+        # Últimos accesos pendientes de escribir: correo -> (id, marca UTC)
+        self.access_flush_interval = ACCESS_FLUSH_INTERVAL
+        self.access_flush_size = ACCESS_FLUSH_SIZE
+        self._pending_access = {}
+        self._flushing_access = {}
+        self._access_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._access_event = threading.Event()
+        self._closing = threading.Event()
+        self._flusher = None
+        atexit.register(self.close)
+        self.init_database()
+    
+    def _open_connection(self):
+        """Abre una conexión con WAL y los pragmas de concurrencia"""
+        conn = sqlite3.connect(self.db_name, timeout=BUSY_TIMEOUT,
+                               check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        # WAL deja leer mientras otro proceso (p. ej. el bot) escribe
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT * 1000}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """
+        Presta una conexión del pool y la devuelve al terminar. Una
+        transacción que quede sin confirmar (por error u omisión) se revierte
+        antes de devolverla.
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_open = self._opened < self.pool_size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    conn = self._open_connection()
+                except Exception:
+                    with self._pool_lock:
+                        self._opened -= 1
+                    raise
+            else:
+                try:
+                    conn = self._pool.get(timeout=POOL_TIMEOUT)
+                except queue.Empty:
+                    raise sqlite3.OperationalError(
+                        f"No hay conexiones libres tras {POOL_TIMEOUT} s") from None
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+    
+    def close(self):
+        """Escribe los últimos accesos pendientes y cierra las conexiones libres del pool"""
+        self._closing.set()
+        self._access_event.set()
+        flusher = self._flusher
+        if flusher is not None and flusher is not threading.current_thread():
+            flusher.join()
+        self._flusher = None
+        self.flush_access()
+        self._closing.clear()
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._pool_lock:
+                self._opened -= 1
+    
+    def _record_access(self, user_id, email):
+        """Anota el último acceso en memoria; el hilo de escritura lo guarda en lote"""
+        # Mismo formato que CURRENT_TIMESTAMP de SQLite (UTC)
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        with self._access_lock:
+            self._pending_access[email] = (user_id, timestamp)
+            full = len(self._pending_access) >= self.access_flush_size
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self._flusher.start()
+        if full:
+            self._access_event.set()
+    
+    def _flush_loop(self):
+        while not self._closing.is_set():
+            self._access_event.wait(self.access_flush_interval)
+            self._access_event.clear()
+            self.flush_access()
+    
+    def flush_access(self):
+        """Escribe en una sola transacción los últimos accesos pendientes"""
+        with self._flush_lock:
+            with self._access_lock:
+                pending = self._pending_access
+                self._pending_access = {}
+                self._flushing_access = pending
+            if not pending:
+                return 0
+            try:
+                with self.connection() as conn:
+                    conn.executemany('''
+                        UPDATE usuarios SET ultimo_acceso = ? WHERE id = ?
+                    ''', [(timestamp, user_id) for user_id, timestamp in pending.values()])
+                    conn.commit()
+            except Exception as e:
+                print(f"Error al guardar últimos accesos: {str(e)}")
+                # Se reintentan en la siguiente escritura salvo que haya uno más reciente
+                with self._access_lock:
+                    for email, value in pending.items():
+                        self._pending_access.setdefault(email, value)
+                    self._flushing_access = {}
+                return 0
+            with self._access_lock:
+                self._flushing_access = {}
+            for email in pending:
+                self.invalidate_user(email)
+            return len(pending)
+    
+    def _pending_access_of(self, email):
+        with self._access_lock:
+            value = self._pending_access.get(email) or self._flushing_access.get(email)
+        return value[1] if value else None
+    
+    def invalidate_user(self, email):
+        """Descarta la entrada en caché de un usuario tras modificarlo"""
+        with self._user_cache_lock:
+            self._cache_generation += 1
+            if self._user_cache.pop(email, None) is not None:
+                self._cache_stats['invalidations'] += 1
+    
+    def cache_info(self):
+        """Contadores de la caché de usuarios: aciertos, fallos, invalidaciones y tamaño"""
+        with self._user_cache_lock:
+            return dict(self._cache_stats, size=len(self._user_cache),
+                        max_size=self.cache_size, ttl=self.cache_ttl)
+    
+    def init_database(self):
+        """Lleva el esquema a la última versión aplicando las migraciones pendientes"""
+        with self.connection() as conn:
+            self.migrate(conn)
+    
+    def migrate(self, conn):
+        """
+        Aplica en orden las migraciones de MIGRATIONS que aún no estén en la
+        base (según PRAGMA user_version) dentro de una sola transacción, y
+        devuelve la versión resultante. Se ejecuta una vez al arrancar: el
+        resto del código da el esquema por hecho.
+        """
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return version
         
-        conn.commit()
-        conn.close()
+        # IMMEDIATE: si otro proceso arranca a la vez, espera y no repite pasos
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, (description, step) in enumerate(MIGRATIONS[version:], version + 1):
+                if callable(step):
+                    step(conn)
+                else:
+                    for statement in step:
+                        conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number}')
+                version = number
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return version
     
     def hash_password(self, password):
         """Genera hash seguro de la contraseña"""
@@ -35,13 +337,12 @@ class DatabaseManager:
     
     def validate_email(self, email):
         """Valida formato de correo electrónico"""
-        pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        return re.match(pattern, email) is not None
+        return re.match(EMAIL_PATTERN, email) is not None
     
     def validate_password(self, password):
         """Valida fortaleza de la contraseña"""
-        if len(password) < 6:
-            return False, "La contraseña debe tener al menos 6 caracteres"
+        if len(password) < MIN_PASSWORD_LENGTH:
+            return False, f"La contraseña debe tener al menos {MIN_PASSWORD_LENGTH} caracteres"
         return True, "Contraseña válida"
     
     def register_user(self, email, password):
@@ -54,72 +355,162 @@ class DatabaseManager:
             return False, message
         
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            
-            # Verificar si el correo ya existe
-            cursor.execute("SELECT id FROM usuarios WHERE correo = ?", (email,))
-            if cursor.fetchone():
-                conn.close()
-                return False, "El correo ya está registrado"
-            
-            # Crear nuevo usuario
-            password_hash = self.hash_password(password)
-            cursor.execute('''
-                INSERT INTO usuarios (correo, contrasena_hash)
-                VALUES (?, ?)
-            ''', (email, password_hash))
-            
-            conn.commit()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                
+                # Verificar si el correo ya existe
+                cursor.execute("SELECT id FROM usuarios WHERE correo = ?", (email,))
+                if cursor.fetchone():
+                    return False, "El correo ya está registrado"
+                
+                # Crear nuevo usuario
+                password_hash = self.hash_password(password)
+                cursor.execute('''
+                    INSERT INTO usuarios (correo, contrasena_hash)
+                    VALUES (?, ?)
+                ''', (email, password_hash))
+                
+                conn.commit()
+            self.invalidate_user(email)
             return True, "Usuario registrado exitosamente"
             
         except Exception as e:
             return False, f"Error al registrar usuario: {str(e)}"
     
+    def bulk_register_users(self, records, batch_size=BULK_BATCH_SIZE):
+        """
+        Registra usuarios en lotes a partir de un iterable de dicts
+        ({'email', 'password'} o {'correo', 'contrasena'}). Genera un reporte
+        por fila: {'fila', 'correo', 'estado', 'mensaje'} con estado
+        'creado', 'duplicado' o 'invalido'.
+        """
+        batch = []
+        for line, record in enumerate(records, start=1):
+            batch.append((line, record))
+            if len(batch) >= batch_size:
+                yield from self._register_batch(batch)
+                batch = []
+        if batch:
+            yield from self._register_batch(batch)
+    
+    def _register_batch(self, batch):
+        """Valida un lote de forma vectorizada y lo inserta en una sola transacción"""
+        df = pd.DataFrame({
+            'fila': [line for line, _ in batch],
+            'correo': [str(r.get('email', r.get('correo')) or '').strip() for _, r in batch],
+            'password': [str(r.get('password', r.get('contrasena')) or '') for _, r in batch],
+        })
+        df['estado'] = 'creado'
+        df['mensaje'] = "Usuario registrado exitosamente"
+        
+        bad_email = ~df['correo'].str.fullmatch(EMAIL_PATTERN)
+        bad_password = df['password'].str.len() < MIN_PASSWORD_LENGTH
+        df.loc[bad_password, ['estado', 'mensaje']] = [
+            'invalido', f"La contraseña debe tener al menos {MIN_PASSWORD_LENGTH} caracteres"]
+        df.loc[bad_email, ['estado', 'mensaje']] = ['invalido', "Formato de correo inválido"]
+        # Solo cuentan como repetidas las filas válidas: una fila inválida
+        # previa con el mismo correo no debe bloquear a la válida
+        valid = df['estado'] == 'creado'
+        repeated = valid & df['correo'].where(valid).duplicated()
+        df.loc[repeated, ['estado', 'mensaje']] = ['duplicado', "Correo repetido en el archivo"]
+        
+        candidates = df['estado'] == 'creado'
+        if candidates.any():
+            emails = df.loc[candidates, 'correo']
+            with self.connection() as conn:
+                # La transacción de escritura abarca la consulta de existentes
+                conn.execute('BEGIN IMMEDIATE')
+                existing = {row[0] for row in conn.execute(
+                    "SELECT correo FROM usuarios WHERE correo IN (SELECT value FROM json_each(?))",
+                    (json.dumps(emails.tolist()),))}
+                taken = candidates & df['correo'].isin(existing)
+                df.loc[taken, ['estado', 'mensaje']] = ['duplicado', "El correo ya está registrado"]
+                new = df[df['estado'] == 'creado']
+                conn.executemany('''
+                    INSERT INTO usuarios (correo, contrasena_hash)
+                    VALUES (?, ?)
+                    ON CONFLICT (correo) DO NOTHING
+                ''', zip(new['correo'], map(self.hash_password, new['password'])))
+                conn.commit()
+            for email in new['correo']:
+                self.invalidate_user(email)
+        
+        for row in df[['fila', 'correo', 'estado', 'mensaje']].itertuples(index=False):
+            yield row._asdict()
+    
     def login_user(self, email, password):
         """Autentica un usuario"""
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            
-            password_hash = self.hash_password(password)
-            cursor.execute('''
-                SELECT id, correo, activo FROM usuarios 
-                WHERE correo = ? AND contrasena_hash = ? AND activo = 1
-            ''', (email, password_hash))
-            
-            user = cursor.fetchone()
-            
-            if user:
-                # Actualizar último acceso
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                
+                password_hash = self.hash_password(password)
                 cursor.execute('''
-                    UPDATE usuarios SET ultimo_acceso = CURRENT_TIMESTAMP 
-                    WHERE id = ?
-                ''', (user[0],))
-                conn.commit()
-                conn.close()
+                    SELECT id, correo, activo FROM usuarios 
+                    WHERE correo = ? AND contrasena_hash = ? AND activo = 1
+                ''', (email, password_hash))
+                
+                user = cursor.fetchone()
+                
+            if user:
+                # El último acceso se escribe en lote (ver flush_access)
+                self._record_access(user[0], email)
                 return True, "Login exitoso", user[1]
             else:
-                conn.close()
                 return False, "Credenciales inválidas", None
                 
         except Exception as e:
             return False, f"Error en login: {str(e)}", None
     
     def get_user_info(self, email):
-        """Obtiene información de un usuario"""
+        """
+        Obtiene información de un usuario. Las consultas repetidas se sirven
+        desde una caché LRU en memoria (también la de usuarios inexistentes)
+        hasta que vence su TTL o se modifica el usuario.
+        """
+        now = time.monotonic()
+        with self._user_cache_lock:
+            entry = self._user_cache.get(email)
+            if entry is not None and entry[0] > now:
+                self._user_cache.move_to_end(email)
+                self._cache_stats['hits'] += 1
+                return self._with_pending_access(entry[1])
+            self._cache_stats['misses'] += 1
+            generation = self._cache_generation
+        
+        user_info = self._query_user_info(email)
+        if user_info is False:
+            return None
+        with self._user_cache_lock:
+            if generation == self._cache_generation:
+                self._user_cache[email] = (now + self.cache_ttl, user_info)
+                self._user_cache.move_to_end(email)
+                while len(self._user_cache) > self.cache_size:
+                    self._user_cache.popitem(last=False)
+        return self._with_pending_access(user_info)
+    
+    def _with_pending_access(self, user_info):
+        """Copia de la información con el último acceso aún no escrito, si lo hay"""
+        if not user_info:
+            return None
+        user_info = dict(user_info)
+        pending = self._pending_access_of(user_info['correo'])
+        if pending is not None:
+            user_info['ultimo_acceso'] = pending
+        return user_info
+    
+    def _query_user_info(self, email):
+        """Lee el usuario de SQLite; None si no existe y False si la consulta falla"""
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT id, correo, fecha_creacion, ultimo_acceso, activo 
-                FROM usuarios WHERE correo = ?
-            ''', (email,))
-            
-            user = cursor.fetchone()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    SELECT id, correo, fecha_creacion, ultimo_acceso, activo 
+                    FROM usuarios WHERE correo = ?
+                ''', (email,))
+                
+                user = cursor.fetchone()
             
             if user:
                 return {
@@ -133,45 +524,73 @@ class DatabaseManager:
             
         except Exception as e:
             print(f"Error al obtener información del usuario: {str(e)}")
-            return None
+            return False
     
     def list_users(self):
         """Lista todos los usuarios (solo para administración)"""
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT id, correo, fecha_creacion, ultimo_acceso, activo 
-                FROM usuarios ORDER BY fecha_creacion DESC
-            ''')
-            
-            users = cursor.fetchall()
-            conn.close()
-            
-            return users
+            return list(self.iter_users())
             
         except Exception as e:
             print(f"Error al listar usuarios: {str(e)}")
             return []
     
+    def _users_query(self, after):
+        query = '''
+            SELECT id, correo, fecha_creacion, ultimo_acceso, activo 
+            FROM usuarios
+        '''
+        params = ()
+        if after:
+            # Keyset: continúa justo después del último usuario entregado
+            query += " WHERE (fecha_creacion, id) < (?, ?)"
+            params = decode_cursor(after)
+        return query + " ORDER BY fecha_creacion DESC, id DESC", params
+    
+    def list_users_page(self, after=None, limit=PAGE_SIZE):
+        """
+        Página de usuarios del más reciente al más antiguo a partir del cursor
+        after. Devuelve (usuarios, siguiente_cursor); el cursor es None en la
+        última página.
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        query, params = self._users_query(after)
+        with self.connection() as conn:
+            users = conn.execute(query + " LIMIT ?", (*params, limit + 1)).fetchall()
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            next_cursor = encode_cursor(users[-1][2], users[-1][0])
+        return users, next_cursor
+    
+    def iter_users(self, after=None, fetch_size=STREAM_FETCH_SIZE):
+        """
+        Recorre los usuarios en orden de alta descendente página a página por
+        keyset. La conexión vuelve al pool entre páginas, así que un cliente
+        lento que descarga la exportación no deja al pool sin conexiones.
+        """
+        while True:
+            users, after = self.list_users_page(after, fetch_size)
+            yield from users
+            if after is None:
+                break
+    
     def deactivate_user(self, email):
         """Desactiva un usuario"""
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                UPDATE usuarios SET activo = 0 WHERE correo = ?
-            ''', (email,))
-            
-            if cursor.rowcount > 0:
-                conn.commit()
-                conn.close()
-                return True, "Usuario desactivado"
-            else:
-                conn.close()
-                return False, "Usuario no encontrado"
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    UPDATE usuarios SET activo = 0 WHERE correo = ?
+                ''', (email,))
+                
+                if cursor.rowcount > 0:
+                    conn.commit()
+                    self.invalidate_user(email)
+                    return True, "Usuario desactivado"
+                else:
+                    return False, "Usuario no encontrado"
                 
         except Exception as e:
             return False, f"Error al desactivar usuario: {str(e)}"
@@ -189,17 +608,113 @@ class DatabaseManager:
             return False, message
         
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            
-            new_password_hash = self.hash_password(new_password)
-            cursor.execute('''
-                UPDATE usuarios SET contrasena_hash = ? WHERE correo = ?
-            ''', (new_password_hash, email))
-            
-            conn.commit()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                
+                new_password_hash = self.hash_password(new_password)
+                cursor.execute('''
+                    UPDATE usuarios SET contrasena_hash = ? WHERE correo = ?
+                ''', (new_password_hash, email))
+                
+                conn.commit()
+            self.invalidate_user(email)
             return True, "Contraseña cambiada exitosamente"
             
         except Exception as e:
             return False, f"Error al cambiar contraseña: {str(e)}"
+    
+    def save_chat_id(self, email, chat_id):
+        """Guarda el chat_id de Telegram del usuario"""
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    UPDATE usuarios SET chat_id = ? WHERE correo = ?
+                ''', (chat_id, email))
+                
+                conn.commit()
+                return cursor.rowcount > 0
+            
+        except Exception as e:
+            print(f"Error al guardar chat_id: {str(e)}")
+            return False
+    
+    def get_chat_id(self, email):
+        """
+        Busca el chat_id de un usuario activo. Devuelve (encontrado, chat_id);
+        chat_id es None si el usuario aún no inició sesión en el bot.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT chat_id FROM usuarios 
+                WHERE correo = ? AND activo = 1
+            ''', (email,))
+            
+            user = cursor.fetchone()
+        
+        if not user:
+            return False, None
+        return True, user[0]
+    
+    def get_chat_ids(self, emails=None):
+        """
+        chat_id de varios usuarios activos en una sola consulta: {correo:
+        chat_id}, con None si aún no iniciaron sesión en el bot. Los correos
+        que no aparecen no existen o están inactivos. Sin emails devuelve
+        todos los usuarios activos que tienen chat_id.
+        """
+        with self.connection() as conn:
+            if emails is None:
+                rows = conn.execute('''
+                    SELECT correo, chat_id FROM usuarios
+                    WHERE activo = 1 AND chat_id IS NOT NULL
+                ''')
+            else:
+                rows = conn.execute('''
+                    SELECT correo, chat_id FROM usuarios
+                    WHERE activo = 1 AND correo IN (SELECT value FROM json_each(?))
+                ''', (json.dumps(list(emails)),))
+            return dict(rows.fetchall())
+
+
+class AsyncDatabaseManager:
+    """
+    Versión awaitable de DatabaseManager para código asyncio (el bot). Cada
+    llamada se encola en un pool de hilos propio y se espera sin bloquear el
+    event loop, así que un disco lento o una base bloqueada no frenan los
+    demás updates de Telegram ni las peticiones HTTP. Las consultas son las
+    mismas de DatabaseManager.
+    """
+    
+    def __init__(self, db, threads=ASYNC_DB_THREADS):
+        if isinstance(db, str):
+            db = DatabaseManager(db)
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='db')
+    
+    async def _run(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args))
+    
+    async def login_user(self, email, password):
+        return await self._run(self.db.login_user, email, password)
+    
+    async def get_user_info(self, email):
+        return await self._run(self.db.get_user_info, email)
+    
+    async def save_chat_id(self, email, chat_id):
+        return await self._run(self.db.save_chat_id, email, chat_id)
+    
+    async def get_chat_id(self, email):
+        return await self._run(self.db.get_chat_id, email)
+    
+    async def get_chat_ids(self, emails=None):
+        return await self._run(self.db.get_chat_ids, emails)
+    
+    async def close(self):
+        """Espera las consultas en curso y cierra la base (escribe los accesos pendientes)"""
+        await asyncio.to_thread(self._executor.shutdown, wait=True)
+        await asyncio.to_thread(self.db.close)
@@ -3,11 +3,18 @@
 """
 Sistema de Login - Base de Datos
 Script principal para interactuar con la base de datos de usuarios
+
+Uso no interactivo:
+    python main.py importar usuarios.csv [--formato csv|ndjson] [--reporte reporte.csv]
 """
 
-from database_manager import DatabaseManager
+from database_manager import DatabaseManager, iter_user_records, BULK_BATCH_SIZE
+import argparse
+import csv
 import getpass
+import os
 import sys
+import time
 
 def print_menu():
     """Muestra el menú principal"""
@@ -89,16 +96,18 @@ def change_password(db):
 def list_users(db):
     """Lista todos los usuarios (función administrativa)"""
     print("\n--- LISTA DE USUARIOS ---")
-    users = db.list_users()
+    # Se imprime a medida que se lee, sin cargar la tabla completa en memoria
+    count = 0
+    for user in db.iter_users():
+        if count == 0:
+            print(f"{'ID':<5} {'Correo':<30} {'Creado':<20} {'Último Acceso':<20} {'Estado'}")
+            print("-" * 80)
+        count += 1
+        status = "Activo" if user[4] else "Inactivo"
+        last_access = user[3] or "Nunca"
+        print(f"{user[0]:<5} {user[1]:<30} {user[2]:<20} {last_access:<20} {status}")
     
-    if users:
-        print(f"{'ID':<5} {'Correo':<30} {'Creado':<20} {'Último Acceso':<20} {'Estado'}")
-        print("-" * 80)
-        for user in users:
-            status = "Activo" if user[4] else "Inactivo"
-            last_access = user[3] or "Nunca"
-            print(f"{user[0]:<5} {user[1]:<30} {user[2]:<20} {last_access:<20} {status}")
-    else:
+    if count == 0:
         print("No hay usuarios registrados")
 
 def deactivate_user(db):
@@ -112,6 +121,53 @@ def deactivate_user(db):
     else:
         print(f"❌ {message}")
 
+def import_users(db, path, fmt=None, report_path=None, batch_size=BULK_BATCH_SIZE):
+    """Registra usuarios de forma masiva desde un archivo CSV o NDJSON"""
+    if fmt is None:
+        fmt = 'ndjson' if path.lower().endswith(('.ndjson', '.jsonl')) else 'csv'
+    counts = {'creado': 0, 'duplicado': 0, 'invalido': 0}
+    report_file = open(report_path, 'w', newline='', encoding='utf-8') if report_path else None
+    writer = csv.DictWriter(report_file, fieldnames=['fila', 'correo', 'estado', 'mensaje']) if report_file else None
+    if writer:
+        writer.writeheader()
+    start = time.time()
+    try:
+        with open(path, 'rb') as f:
+            for row in db.bulk_register_users(iter_user_records(f, fmt), batch_size):
+                counts[row['estado']] += 1
+                if writer:
+                    writer.writerow(row)
+                elif row['estado'] != 'creado':
+                    print(f"❌ Fila {row['fila']}: {row['correo']} - {row['mensaje']}")
+    finally:
+        if report_file:
+            report_file.close()
+    elapsed = max(time.time() - start, 1e-9)
+    total = sum(counts.values())
+    print(f"✅ {counts['creado']} creados, {counts['duplicado']} duplicados, {counts['invalido']} inválidos "
+          f"({total} filas en {elapsed:.2f} s, {total / elapsed:.0f} filas/s)")
+    return counts
+
+def run_command(argv):
+    """Ejecuta un subcomando sin menú interactivo"""
+    parser = argparse.ArgumentParser(description="Administración de usuarios")
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+    importar = subparsers.add_parser('importar', help="Registro masivo desde CSV o NDJSON")
+    importar.add_argument('archivo', help="CSV con columnas email,password o NDJSON con esos campos")
+    importar.add_argument('--formato', choices=['csv', 'ndjson'], help="Por defecto se deduce de la extensión")
+    importar.add_argument('--reporte', help="Ruta del CSV con el resultado de cada fila")
+    importar.add_argument('--lote', type=int, default=BULK_BATCH_SIZE, help="Filas por transacción")
+    importar.add_argument('--db', default="login_database.db", help="Archivo de la base de datos")
+    args = parser.parse_args(argv)
+    
+    if not os.path.exists(args.archivo):
+        print(f"❌ No existe el archivo {args.archivo}")
+        return 1
+    db = DatabaseManager(args.db)
+    counts = import_users(db, args.archivo, args.formato, args.reporte, args.lote)
+    db.close()
+    return 0 if counts['invalido'] == 0 else 2
+
 def main():
     """Función principal"""
     # Inicializar la base de datos
@@ -142,4 +198,6 @@ def main():
         input("\nPresione Enter para continuar...")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_command(sys.argv[1:]))
     main()
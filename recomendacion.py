@@ -1,11 +1,63 @@
-import google.generativeai as genai
+import asyncio
+import html
+import logging
+import random
+import threading
+import weakref
 
-genai.configure(api_key="YOUR API KEY")
+# Tiempo máximo (segundos) para obtener una recomendación de Gemini, contando
+# todos los reintentos; al agotarse se responde con la plantilla
+GEMINI_TIMEOUT = 8
+# Llamadas simultáneas a Gemini como máximo por event loop
+GEMINI_CONCURRENCY = 4
+# Reintentos tras un error y espera base (se duplica en cada intento, con jitter)
+GEMINI_RETRIES = 2
+GEMINI_BACKOFF = 0.5
 
-model = genai.GenerativeModel('gemini-2.5-flash-lite')
+_model = None
+_model_error = None
+_model_lock = threading.Lock()
+_semaphores = weakref.WeakKeyDictionary()
 
-def generar_precauciones(perfil, alteraciones):
-    prompt = f'''
+
+def _crear_modelo():
+    import google.generativeai as genai
+    genai.configure(api_key="YOUR API KEY")
+    return genai.GenerativeModel('gemini-2.5-flash-lite')
+
+
+def _modelo_gemini():
+    """
+    Modelo de Gemini por defecto; se crea al primer uso. Si no se puede crear
+    (paquete no instalado o configuración inválida) el error se guarda y se
+    vuelve a lanzar en las siguientes llamadas sin intentarlo de nuevo.
+    """
+    global _model, _model_error
+    with _model_lock:
+        if _model is None and _model_error is None:
+            try:
+                _model = _crear_modelo()
+            except Exception as e:
+                _model_error = e
+        if _model_error is not None:
+            raise _model_error
+        return _model
+
+
+async def cargar_modelo():
+    """
+    Crea el modelo de Gemini en un hilo, sin bloquear el event loop. Conviene
+    llamarla al arrancar; devuelve None si Gemini no está disponible.
+    """
+    try:
+        return await asyncio.to_thread(_modelo_gemini)
+    except Exception as e:
+        logging.warning(f"Gemini no disponible: {e}")
+        return None
+
+
+def _construir_prompt(perfil, alteraciones):
+    return f'''
     Genera recomendaciones de salud personalizadas y directas basadas en el siguiente perfil de usuario {perfil} y las alteraciones ambientales enlistadas {alteraciones}. La respuesta debe ser únicamente la recomendación o alerta, formulada de manera clara, concisa y fácil de entender.
 
 Si el tipo_usuario es "persona", la recomendación debe ser un consejo directo para ese individuo.
@@ -13,8 +65,109 @@ Si el tipo_usuario es "persona", la recomendación debe ser un consejo directo p
 Si el tipo_usuario es "empresa", la recomendación debe enfocarse en acciones para proteger a sus empleados o a la comunidad afectada por sus operaciones.
 
 Si el tipo_usuario es "gobierno", la recomendación debe ser una alerta de salud pública o acciones sugeridas para la comunidad.'''
-    response = model.generate_content(prompt)   
+
+
+def generar_precauciones(perfil, alteraciones):
+    response = _modelo_gemini().generate_content(_construir_prompt(perfil, alteraciones))
     return response.text
 
+
+# Recomendaciones precalculadas por tipo de usuario para cuando Gemini no responde
+PLANTILLAS = {
+    "persona": (
+        "⚠️ <b>Alerta de calidad del aire en {zone}</b>\n\n"
+        "Se detectaron niveles {risk_level} de {contaminants}.\n"
+        "• Evita actividades físicas intensas al aire libre.\n"
+        "• Mantén ventanas cerradas en las horas de mayor contaminación.\n"
+        "• Si tienes asma o problemas respiratorios, ten tu medicamento a la mano.\n"
+        "• Acude al médico si presentas tos persistente o dificultad para respirar."
+    ),
+    "empresa": (
+        "⚠️ <b>Alerta de calidad del aire en {zone}</b>\n\n"
+        "Se detectaron niveles {risk_level} de {contaminants}.\n"
+        "• Reduce las tareas al aire libre y rota al personal expuesto.\n"
+        "• Proporciona mascarillas adecuadas a quienes trabajen en exteriores.\n"
+        "• Revisa la ventilación y filtración de las instalaciones.\n"
+        "• Pospón las operaciones que aumenten las emisiones en la zona."
+    ),
+    "gobierno": (
+        "⚠️ <b>Alerta de salud pública en {zone}</b>\n\n"
+        "Se detectaron niveles {risk_level} de {contaminants}.\n"
+        "• Informa a la población y a escuelas y centros de salud.\n"
+        "• Recomienda suspender actividades físicas al aire libre.\n"
+        "• Considera restringir fuentes de emisión mientras dure el episodio.\n"
+        "• Refuerza la atención a grupos vulnerables."
+    ),
+}
+
+
+def recomendacion_plantilla(perfil, alteraciones):
+    """Recomendación sin Gemini a partir de PLANTILLAS (HTML listo para el bot)"""
+    plantilla = PLANTILLAS.get(perfil.get("tipo_usuario"), PLANTILLAS["persona"])
+    return plantilla.format(
+        zone=html.escape(str(alteraciones.get("zone", "tu zona"))),
+        risk_level=html.escape(str(alteraciones.get("risk_level", "elevados"))),
+        contaminants=html.escape(str(alteraciones.get("contaminants", "no especificados"))),
+    )
+
+
+def _semaforo():
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    return semaphore
+
+
+async def _generar(model, prompt):
+    # El SDK de Gemini trae versión asíncrona; un modelo que solo tenga la
+    # síncrona se ejecuta en un hilo para no bloquear el event loop
+    if hasattr(model, 'generate_content_async'):
+        response = await model.generate_content_async(prompt)
+    else:
+        response = await asyncio.to_thread(model.generate_content, prompt)
+    return response.text
+
+
+async def generar_precauciones_async(perfil, alteraciones, model=None, timeout=None, retries=None):
+    """
+    Versión asíncrona de generar_precauciones. Limita las llamadas
+    simultáneas a GEMINI_CONCURRENCY, reintenta los errores con espera
+    exponencial y nunca tarda más de timeout segundos: si Gemini no responde
+    a tiempo o falla en todos los intentos devuelve recomendacion_plantilla.
+    Si el modelo no se puede crear no se reintenta: se usa la plantilla.
+    model permite usar otro modelo (p. ej. uno falso en las pruebas).
+    """
+    timeout = GEMINI_TIMEOUT if timeout is None else timeout
+    retries = GEMINI_RETRIES if retries is None else retries
+    prompt = _construir_prompt(perfil, alteraciones)
+
+    async def intentar():
+        # Un error al crear el modelo no se arregla reintentando
+        modelo = model or await asyncio.to_thread(_modelo_gemini)
+        for intento in range(retries + 1):
+            try:
+                # El semáforo solo cubre la llamada; durante la espera entre
+                # intentos otras peticiones pueden usar el turno
+                async with _semaforo():
+                    texto = await _generar(modelo, prompt)
+                if texto and texto.strip():
+                    return texto
+                raise ValueError("Respuesta vacía de Gemini")
+            except Exception as e:
+                logging.warning(f"Gemini falló (intento {intento + 1}): {e}")
+                if intento == retries:
+                    raise
+            await asyncio.sleep(GEMINI_BACKOFF * 2 ** intento * random.uniform(0.5, 1.5))
+
+    try:
+        return await asyncio.wait_for(intentar(), timeout)
+    except asyncio.TimeoutError:
+        logging.warning(f"Gemini no respondió en {timeout}s; se usa la plantilla")
+    except Exception:
+        logging.warning("Gemini no disponible; se usa la plantilla")
+    return recomendacion_plantilla(perfil, alteraciones)
+
+
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script de pruebas del envío masivo de alertas contra un servidor local que
+imita la Bot API de Telegram
+"""
+
+from alert_dispatcher import AlertDispatcher, TokenBucket, SENT, FAILED, NO_CHAT
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+import asyncio
+import time
+
+# Chats con respuesta especial en el servidor falso
+THROTTLED_CHAT = 13
+MISSING_CHAT = 99
+
+
+async def _fake_bot_api():
+    """Servidor local con sendMessage; devuelve (runner, url, envíos recibidos)"""
+    received = []
+    throttled = set()
+
+    async def send_message(request):
+        data = await request.post()
+        chat_id = int(data['chat_id'])
+        if chat_id == MISSING_CHAT:
+            return web.json_response({"ok": False, "error_code": 400,
+                                      "description": "Bad Request: chat not found"})
+        if chat_id == THROTTLED_CHAT and chat_id not in throttled:
+            throttled.add(chat_id)
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}})
+        received.append((chat_id, time.monotonic()))
+        return web.json_response({"ok": True, "result": {
+            "message_id": len(received), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": data['text']}})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/sendMessage', send_message)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}", received
+
+
+async def _run_batch():
+    runner, url, received = await _fake_bot_api()
+    session = AiohttpSession(api=TelegramAPIServer.from_base(url))
+    bot = Bot(token="123456:PRUEBA", session=session)
+
+    async def send(chat_id, text):
+        await bot.send_message(chat_id, text)
+
+    dispatcher = AlertDispatcher(send, global_rate=20, chat_rate=1, concurrency=4)
+    dispatcher.start()
+    deliveries = [(f"u{i}@ejemplo.com", 1000 + i, "Alerta") for i in range(30)]
+    # Dos usuarios que comparten chat, uno con 429 y uno con chat inexistente
+    deliveries += [("a@ejemplo.com", 7, "Alerta"), ("b@ejemplo.com", 7, "Alerta"),
+                   ("lento@ejemplo.com", THROTTLED_CHAT, "Alerta"),
+                   ("perdido@ejemplo.com", MISSING_CHAT, "Alerta")]
+    start = time.monotonic()
+    batch_id = dispatcher.submit(deliveries, {"nuevo@ejemplo.com": NO_CHAT})
+    await dispatcher.join()
+    elapsed = time.monotonic() - start
+    status = dispatcher.status(batch_id)
+
+    await dispatcher.stop()
+    await session.close()
+    await runner.cleanup()
+    return status, received, start, elapsed
+
+
+async def _run_paused_chat():
+    """Una sola tarea de envío: dos alertas al mismo chat seguidas de otros chats"""
+    runner, url, received = await _fake_bot_api()
+    session = AiohttpSession(api=TelegramAPIServer.from_base(url))
+    bot = Bot(token="123456:PRUEBA", session=session)
+
+    async def send(chat_id, text):
+        await bot.send_message(chat_id, text)
+
+    dispatcher = AlertDispatcher(send, global_rate=20, chat_rate=1, concurrency=1)
+    dispatcher.start()
+    deliveries = [("a@ejemplo.com", 7, "Alerta"), ("b@ejemplo.com", 7, "Alerta")]
+    deliveries += [(f"u{i}@ejemplo.com", 1000 + i, "Alerta") for i in range(10)]
+    start = time.monotonic()
+    dispatcher.submit(deliveries)
+    await dispatcher.join()
+
+    await dispatcher.stop()
+    await session.close()
+    await runner.cleanup()
+    return received, start
+
+
+def test_alert_dispatcher():
+    """Ejecuta pruebas básicas del envío masivo de alertas"""
+    print("🧪 Iniciando pruebas del envío masivo de alertas...")
+
+    # Prueba 1: La cubeta de tokens limita la velocidad
+    print("\n1. Probando la cubeta de tokens...")
+
+    async def drain():
+        bucket = TokenBucket(rate=50, capacity=5)
+        start = time.monotonic()
+        for _ in range(30):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    elapsed = asyncio.run(drain())
+    # 5 tokens disponibles al inicio y 25 más a 50/s: al menos 0,5 s
+    print(f"   Resultado: {'✅' if elapsed >= 0.45 else '❌'} 30 tokens en {elapsed:.2f}s")
+    assert elapsed >= 0.45
+
+    status, received, start, elapsed = asyncio.run(_run_batch())
+    by_email = {r['correo']: r for r in status['destinatarios']}
+
+    # Prueba 2: Estado por destinatario
+    print("\n2. Probando el estado por destinatario...")
+    ok = (status['terminado'] and status['conteo'] == {SENT: 33, FAILED: 1, NO_CHAT: 1}
+          and by_email['perdido@ejemplo.com']['estado'] == FAILED)
+    print(f"   Resultado: {'✅' if ok else '❌'} {status['conteo']}")
+    assert ok
+
+    # Prueba 3: Límite global
+    print("\n3. Probando el límite global...")
+    first_second = sum(1 for _, t in received if t - start < 1.0)
+    ok = first_second <= 20 + 20
+    print(f"   Resultado: {'✅' if ok else '❌'} {first_second} envíos en el primer segundo, "
+          f"{len(received)} en {elapsed:.2f}s")
+    assert ok and elapsed >= (len(received) - 20) / 20 * 0.9
+
+    # Prueba 4: Límite por chat y reintento tras 429
+    print("\n4. Probando el límite por chat y el reintento tras 429...")
+    shared = [t for chat, t in received if chat == 7]
+    throttled = by_email['lento@ejemplo.com']
+    ok = (len(shared) == 2 and shared[1] - shared[0] >= 0.9
+          and throttled['estado'] == SENT and throttled['intentos'] == 2)
+    print(f"   Resultado: {'✅' if ok else '❌'} separación en el mismo chat = "
+          f"{shared[1] - shared[0]:.2f}s, intentos tras 429 = {throttled['intentos']}")
+    assert ok
+
+    # Prueba 5: Un chat en pausa no bloquea a la tarea de envío
+    print("\n5. Probando que un chat en pausa no detiene a los demás...")
+    received, start = asyncio.run(_run_paused_chat())
+    others = [t - start for chat, t in received if chat != 7]
+    shared = [t for chat, t in received if chat == 7]
+    ok = len(others) == 10 and max(others) < 0.5 and len(shared) == 2 and shared[1] - shared[0] >= 0.9
+    print(f"   Resultado: {'✅' if ok else '❌'} otros chats atendidos en {max(others):.2f}s, "
+          f"separación en el chat en pausa = {shared[1] - shared[0]:.2f}s")
+    assert ok
+
+    print("\n🎉 Pruebas completadas!")
+
+
+if __name__ == "__main__":
+    test_alert_dispatcher()
@@ -4,8 +4,11 @@
 Script de pruebas para la base de datos de login
 """
 
-from database_manager import DatabaseManager
+from database_manager import DatabaseManager, AsyncDatabaseManager, iter_user_records, SCHEMA_VERSION
+import asyncio
 import os
+import sqlite3
+import threading
 
 def test_database():
     """Ejecuta pruebas básicas de la base de datos"""
@@ -13,6 +16,8 @@ def test_database():
     
     # Crear instancia de la base de datos
     db = DatabaseManager("test_login.db")
+    # Los últimos accesos solo se escriben cuando la prueba 18 lo pide
+    db.access_flush_interval = 60
     
     # Prueba 1: Registrar usuario válido
     print("\n1. Probando registro de usuario válido...")
@@ -77,12 +82,165 @@ def test_database():
     success, message, user = db.login_user("test@ejemplo.com", "nuevapassword")
     print(f"   Resultado: {'✅' if success else '❌'} {message}")
     
+    # Prueba 13: Registros concurrentes compartiendo el pool de conexiones
+    print("\n13. Probando registros concurrentes con el pool...")
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(
+        db.register_user(f"concurrente{i}@ejemplo.com", "password123")[0])) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with db.connection() as conn:
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    print(f"   Resultado: {'✅' if all(results) and db._opened <= db.pool_size else '❌'} "
+          f"{sum(results)} registros con {db._opened} conexiones ({journal_mode})")
+    assert all(results) and db._opened <= db.pool_size and journal_mode == 'wal'
+    
+    # Prueba 14: chat_id del bot guardado por la misma capa
+    print("\n14. Probando chat_id del bot...")
+    db.save_chat_id("concurrente0@ejemplo.com", 12345)
+    found, chat_id = db.get_chat_id("concurrente0@ejemplo.com")
+    print(f"   Resultado: {'✅' if found and chat_id == 12345 else '❌'} chat_id = {chat_id}")
+    assert db.get_chat_id("test@ejemplo.com") == (False, None)
+    
+    # Prueba 15: Registro masivo desde CSV con reporte por fila
+    print("\n15. Probando registro masivo...")
+    rows = ["email,password", "masivo1@ejemplo.com,password123", "masivo2@ejemplo.com,123",
+            "correo-invalido,password123", "test@ejemplo.com,password123", "masivo1@ejemplo.com,password123"]
+    report = list(db.bulk_register_users(iter_user_records("\n".join(rows).encode()), batch_size=2))
+    states = [row['estado'] for row in report]
+    print(f"   Resultado: {'✅' if states.count('creado') == 1 else '❌'} {states}")
+    assert states == ['creado', 'invalido', 'invalido', 'duplicado', 'duplicado']
+    assert db.login_user("masivo1@ejemplo.com", "password123")[0]
+    # Una fila inválida antes de una válida con el mismo correo no la bloquea
+    report = list(db.bulk_register_users([{'email': 'masivo3@ejemplo.com', 'password': '123'},
+                                          {'email': 'masivo3@ejemplo.com', 'password': 'password123'}]))
+    assert [row['estado'] for row in report] == ['invalido', 'creado']
+    assert db.get_user_info("masivo3@ejemplo.com") is not None
+    
+    # Prueba 16: Listado paginado por cursor
+    print("\n16. Probando paginación por cursor...")
+    pages, after = [], None
+    while True:
+        page, after = db.list_users_page(after, limit=5)
+        pages.append(page)
+        if after is None:
+            break
+    paged = [user for page in pages for user in page]
+    print(f"   Resultado: {'✅' if paged == db.list_users() else '❌'} {len(paged)} usuarios en {len(pages)} páginas")
+    assert paged == db.list_users() == list(db.iter_users(fetch_size=3))
+    # Una exportación a medio descargar no retiene la conexión del pool
+    single = DatabaseManager("test_login.db", pool_size=1)
+    export = single.iter_users(fetch_size=2)
+    next(export)
+    assert single.register_user("exportando@ejemplo.com", "password123")[0]
+    export.close()
+    single.close()
+    
+    # Prueba 17: Caché de consultas de usuario con invalidación
+    print("\n17. Probando caché de get_user_info...")
+    before = db.cache_info()
+    first = db.get_user_info("masivo1@ejemplo.com")
+    second = db.get_user_info("masivo1@ejemplo.com")
+    after = db.cache_info()
+    db.deactivate_user("masivo1@ejemplo.com")
+    updated = db.get_user_info("masivo1@ejemplo.com")
+    hits = after['hits'] - before['hits']
+    print(f"   Resultado: {'✅' if hits == 1 and not updated['activo'] else '❌'} "
+          f"{hits} acierto(s), activo tras desactivar = {updated['activo']}")
+    assert first == second and first['activo'] and hits == 1 and not updated['activo']
+    
+    # Prueba 18: Último acceso en memoria y escritura en lote
+    print("\n18. Probando escritura diferida del último acceso...")
+    db.register_user("acceso@ejemplo.com", "password123")
+    db.login_user("acceso@ejemplo.com", "password123")
+    with db.connection() as conn:
+        stored = conn.execute("SELECT ultimo_acceso FROM usuarios WHERE correo = ?",
+                              ("acceso@ejemplo.com",)).fetchone()[0]
+    pending = db.get_user_info("acceso@ejemplo.com")['ultimo_acceso']
+    flushed = db.flush_access()
+    with db.connection() as conn:
+        written = conn.execute("SELECT ultimo_acceso FROM usuarios WHERE correo = ?",
+                               ("acceso@ejemplo.com",)).fetchone()[0]
+    ok = stored is None and pending is not None and written == pending and flushed >= 1
+    print(f"   Resultado: {'✅' if ok else '❌'} pendiente = {pending}, "
+          f"escrito = {written}, {flushed} acceso(s) en lote")
+    assert ok
+    assert db.get_user_info("acceso@ejemplo.com")['ultimo_acceso'] == written
+    
+    # Prueba 19: Migraciones sobre una base creada por versiones anteriores
+    print("\n19. Probando migraciones del esquema...")
+    legacy = sqlite3.connect("test_legacy.db")
+    legacy.execute('''
+        CREATE TABLE usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            correo TEXT UNIQUE NOT NULL,
+            contrasena_hash TEXT NOT NULL,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ultimo_acceso TIMESTAMP,
+            activo BOOLEAN DEFAULT 1,
+            chat_id INTEGER
+        )
+    ''')
+    legacy.execute("INSERT INTO usuarios (correo, contrasena_hash, chat_id) VALUES ('viejo@ejemplo.com', 'x', 42)")
+    legacy.commit()
+    legacy.close()
+    migrated = DatabaseManager("test_legacy.db")
+    with migrated.connection() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        indexes = {row[1] for row in conn.execute("PRAGMA index_list(usuarios)")}
+        again = migrated.migrate(conn)
+    found, chat_id = migrated.get_chat_id("viejo@ejemplo.com")
+    migrated.close()
+    ok = (version == again == SCHEMA_VERSION and chat_id == 42
+          and {'idx_usuarios_chat_id', 'idx_usuarios_correo_activo'} <= indexes)
+    print(f"   Resultado: {'✅' if ok else '❌'} versión {version}, chat_id conservado = {chat_id}")
+    assert ok
+    
+    # Prueba 20: Acceso asíncrono sin bloquear el event loop
+    print("\n20. Probando AsyncDatabaseManager con la base bloqueada...")
+    async_db = AsyncDatabaseManager(db)
+    
+    async def locked_write():
+        # Otra conexión toma el bloqueo de escritura y lo suelta a los 0,3 s
+        blocker = sqlite3.connect("test_login.db", check_same_thread=False)
+        blocker.execute("BEGIN IMMEDIATE")
+        asyncio.get_running_loop().call_later(0.3, blocker.commit)
+        ticks = 0
+        task = asyncio.ensure_future(async_db.save_chat_id("acceso@ejemplo.com", 777))
+        while not task.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        blocker.close()
+        login = await async_db.login_user("acceso@ejemplo.com", "password123")
+        return task.result(), ticks, login, await async_db.get_chat_id("acceso@ejemplo.com")
+    
+    saved, ticks, login, chat = asyncio.run(locked_write())
+    ok = saved and ticks >= 10 and login[0] and chat == (True, 777)
+    print(f"   Resultado: {'✅' if ok else '❌'} {ticks} vueltas del event loop mientras "
+          f"esperaba el bloqueo, chat_id = {chat[1]}")
+    assert ok
+    
+    # Prueba 21: chat_id de varios usuarios en una consulta
+    print("\n21. Probando get_chat_ids...")
+    chats = db.get_chat_ids(["acceso@ejemplo.com", "test@ejemplo.com", "nadie@ejemplo.com"])
+    with_chat = db.get_chat_ids()
+    # test@ejemplo.com está desactivado y nadie@ejemplo.com no existe
+    ok = (chats == {"acceso@ejemplo.com": 777} and with_chat["acceso@ejemplo.com"] == 777
+          and None not in with_chat.values())
+    print(f"   Resultado: {'✅' if ok else '❌'} {chats}")
+    assert ok
+    
     print("\n🎉 Pruebas completadas!")
     
     # Limpiar archivo de prueba
-    if os.path.exists("test_login.db"):
-        os.remove("test_login.db")
-        print("🧹 Archivo de prueba eliminado")
+    db.close()
+    for name in ("test_login.db", "test_legacy.db"):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+    print("🧹 Archivo de prueba eliminado")
 
 if __name__ == "__main__":
     test_database()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script de pruebas del cliente asíncrono de Gemini con modelos falsos locales
+"""
+
+import recomendacion
+from recomendacion import generar_precauciones_async, recomendacion_plantilla
+import asyncio
+import time
+
+PERFIL = {"tipo_usuario": "empresa"}
+ALTERACIONES = {"zone": "Centro", "risk_level": "altos", "contaminants": "NO2"}
+
+
+class _Respuesta:
+    def __init__(self, text):
+        self.text = text
+
+
+class ModeloFalso:
+    """Imita generate_content_async: tarda delay segundos y falla las primeras fallas veces"""
+
+    def __init__(self, delay=0.0, fallas=0, texto="Recomendación de prueba"):
+        self.delay = delay
+        self.fallas = fallas
+        self.texto = texto
+        self.llamadas = 0
+        self.activas = 0
+        self.max_activas = 0
+
+    async def generate_content_async(self, prompt):
+        self.llamadas += 1
+        self.activas += 1
+        self.max_activas = max(self.max_activas, self.activas)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.llamadas <= self.fallas:
+                raise ConnectionError("Gemini no disponible")
+            return _Respuesta(self.texto)
+        finally:
+            self.activas -= 1
+
+
+class ModeloSincrono:
+    """Modelo con solo generate_content (bloqueante)"""
+
+    def generate_content(self, prompt):
+        time.sleep(0.2)
+        return _Respuesta("Recomendación síncrona")
+
+
+def test_recomendacion():
+    """Ejecuta pruebas básicas del cliente de Gemini"""
+    print("🧪 Iniciando pruebas del cliente de Gemini...")
+    recomendacion.GEMINI_BACKOFF = 0.01
+    plantilla = recomendacion_plantilla(PERFIL, ALTERACIONES)
+
+    # Prueba 1: Respuesta normal
+    print("\n1. Probando respuesta del modelo...")
+    texto = asyncio.run(generar_precauciones_async(PERFIL, ALTERACIONES, model=ModeloFalso()))
+    print(f"   Resultado: {'✅' if texto == 'Recomendación de prueba' else '❌'} {texto}")
+    assert texto == "Recomendación de prueba"
+
+    # Prueba 2: Reintento tras errores
+    print("\n2. Probando reintentos tras errores...")
+    modelo = ModeloFalso(fallas=2)
+    texto = asyncio.run(generar_precauciones_async(PERFIL, ALTERACIONES, model=modelo, retries=2))
+    ok = texto == "Recomendación de prueba" and modelo.llamadas == 3
+    print(f"   Resultado: {'✅' if ok else '❌'} {modelo.llamadas} llamadas")
+    assert ok
+
+    # Prueba 3: Plantilla si el modelo sigue fallando
+    print("\n3. Probando plantilla con el modelo caído...")
+    modelo = ModeloFalso(fallas=10)
+    texto = asyncio.run(generar_precauciones_async(PERFIL, ALTERACIONES, model=modelo, retries=1))
+    ok = texto == plantilla and modelo.llamadas == 2 and "Centro" in texto
+    print(f"   Resultado: {'✅' if ok else '❌'} plantilla tras {modelo.llamadas} llamadas")
+    assert ok
+
+    # Prueba 4: Plantilla si el modelo es lento
+    print("\n4. Probando el tiempo máximo...")
+    start = time.monotonic()
+    texto = asyncio.run(generar_precauciones_async(PERFIL, ALTERACIONES, model=ModeloFalso(delay=5), timeout=0.2))
+    elapsed = time.monotonic() - start
+    ok = texto == plantilla and elapsed < 1
+    print(f"   Resultado: {'✅' if ok else '❌'} plantilla en {elapsed:.2f}s")
+    assert ok
+
+    # Prueba 5: Límite de llamadas simultáneas
+    print("\n5. Probando el límite de concurrencia...")
+    modelo = ModeloFalso(delay=0.05)
+
+    async def varias():
+        return await asyncio.gather(*[generar_precauciones_async(PERFIL, ALTERACIONES, model=modelo)
+                                      for _ in range(12)])
+
+    textos = asyncio.run(varias())
+    ok = all(t == "Recomendación de prueba" for t in textos) and modelo.max_activas <= recomendacion.GEMINI_CONCURRENCY
+    print(f"   Resultado: {'✅' if ok else '❌'} {modelo.max_activas} llamadas simultáneas como máximo")
+    assert ok
+
+    # Prueba 6: Un modelo síncrono no bloquea el event loop
+    print("\n6. Probando modelo síncrono sin bloquear el event loop...")
+
+    async def con_latidos():
+        latidos = 0
+        tarea = asyncio.ensure_future(generar_precauciones_async(PERFIL, ALTERACIONES, model=ModeloSincrono()))
+        while not tarea.done():
+            latidos += 1
+            await asyncio.sleep(0.01)
+        return tarea.result(), latidos
+
+    texto, latidos = asyncio.run(con_latidos())
+    ok = texto == "Recomendación síncrona" and latidos >= 10
+    print(f"   Resultado: {'✅' if ok else '❌'} {latidos} vueltas del event loop durante la llamada")
+    assert ok
+
+    # Prueba 7: Sin reintentos si el modelo no se puede crear
+    print("\n7. Probando el modelo no disponible...")
+    creaciones = []
+
+    def sin_sdk():
+        creaciones.append(1)
+        raise ImportError("No module named 'google.generativeai'")
+
+    crear_modelo, recomendacion._crear_modelo = recomendacion._crear_modelo, sin_sdk
+    recomendacion._model = recomendacion._model_error = None
+    recomendacion.GEMINI_BACKOFF = 0.5
+    try:
+        start = time.monotonic()
+        textos = [asyncio.run(generar_precauciones_async(PERFIL, ALTERACIONES)) for _ in range(2)]
+        elapsed = time.monotonic() - start
+    finally:
+        recomendacion._crear_modelo = crear_modelo
+        recomendacion._model = recomendacion._model_error = None
+    ok = all(t == plantilla for t in textos) and len(creaciones) == 1 and elapsed < 0.2
+    print(f"   Resultado: {'✅' if ok else '❌'} plantilla en {elapsed:.2f}s, {len(creaciones)} intento de crear el modelo")
+    assert ok
+
+    # Prueba 8: La espera entre reintentos no ocupa el semáforo
+    print("\n8. Probando que el reintento libera el turno...")
+    recomendacion.GEMINI_CONCURRENCY = 1
+
+    async def reintento_y_otra():
+        lenta = asyncio.ensure_future(generar_precauciones_async(
+            PERFIL, ALTERACIONES, model=ModeloFalso(fallas=1), retries=1))
+        await asyncio.sleep(0.05)
+        start = time.monotonic()
+        texto = await generar_precauciones_async(PERFIL, ALTERACIONES, model=ModeloFalso())
+        elapsed = time.monotonic() - start
+        return texto, elapsed, await lenta
+
+    try:
+        texto, elapsed, texto_lenta = asyncio.run(reintento_y_otra())
+    finally:
+        recomendacion.GEMINI_CONCURRENCY = 4
+        recomendacion.GEMINI_BACKOFF = 0.01
+    ok = texto == texto_lenta == "Recomendación de prueba" and elapsed < 0.15
+    print(f"   Resultado: {'✅' if ok else '❌'} otra petición atendida en {elapsed:.2f}s durante la espera")
+    assert ok
+
+    print("\n🎉 Pruebas completadas!")
+
+
+if __name__ == "__main__":
+    test_recomendacion()
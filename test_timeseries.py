@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script de pruebas para la ingestión y caché de series temporales
+"""
+
+import timeseries_manager
+from timeseries_manager import (TimeseriesManager, REGIONS, query_series, lttb_indices, arrays_to_columnar, load_normalized_series,
+                                load_local_partials, load_upload_partials, partials_summary, _normalize_single, _normalize_csv_chunked,
+                                _detect_schema, _detect_date_format)
+from timeseries_store import TimeseriesStore
+import numpy as np
+import pandas as pd
+import base64
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+def _write_csv(path, rows):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('time,lat,lon,value\n')
+        for row in rows:
+            f.write(','.join(str(v) for v in row) + '\n')
+
+
+def test_timeseries_cache():
+    """Ejecuta pruebas básicas de la caché de series temporales"""
+    print("🧪 Iniciando pruebas de la caché de series temporales...")
+
+    directory = tempfile.mkdtemp()
+    no2_path = os.path.join(directory, 'datos_tempo_no2_completo.csv')
+    hch_path = os.path.join(directory, 'datos_tempo_hcho_completo.csv')
+    _write_csv(no2_path, [
+        ('2024-01-01 10:00', 19.4, -99.1, 1.0),
+        ('2024-01-01 12:00', 19.4, -99.1, 3.0),
+        ('2024-01-02 10:00', 19.4, -99.1, 5.0),
+    ])
+    _write_csv(hch_path, [
+        ('24/01/01', 19.4, -99.1, 0.5),
+        ('24/01/02', 19.4, -99.1, 0.7),
+    ])
+
+    try:
+        series = TimeseriesManager(directory)
+
+        # Prueba 1: Primera carga síncrona
+        print("\n1. Probando primera carga...")
+        data = series.get_data()
+        print(f"   Resultado: {'✅' if len(data) == 2 else '❌'} {len(data)} puntos")
+        assert [d['date'] for d in data] == ['2024-01-01', '2024-01-02']
+        assert data[0]['no2'] == 2.0
+
+        # Prueba 2: Sin cambios se reutiliza el mismo snapshot
+        print("\n2. Probando reutilización del snapshot...")
+        first = series.get()
+        assert series.get() is first
+        print("   Resultado: ✅ Snapshot reutilizado")
+
+        # Prueba 3: La serie normalizada se persiste junto al CSV
+        print("\n3. Probando caché en disco...")
+        assert os.path.exists(no2_path + '.no2.npz')
+        assert os.path.exists(hch_path + '.hch.npz')
+        restarted = TimeseriesManager(directory)
+        assert restarted.get_data() == data
+        print("   Resultado: ✅ Serie recuperada desde la caché .npz")
+
+        # Prueba 4: La lectura por bloques coincide con la lectura completa
+        print("\n4. Probando ingestión por bloques...")
+        chunked = _normalize_csv_chunked(no2_path, 'no2', chunksize=1)
+        full = _normalize_single(pd.read_csv(no2_path), 'no2')
+        assert chunked.equals(full)
+        print(f"   Resultado: ✅ {len(chunked)} días idénticos")
+
+        # Prueba 5: Recorte por rango y reducción de puntos
+        print("\n5. Probando consulta por rango...")
+        sliced = series.query(start='2024-01-02', end='2024-01-02')
+        assert list(sliced['no2']) == [5.0]
+        dates = pd.date_range('2024-01-01', periods=1000, freq='D').to_numpy()
+        arrays = {'date': dates, 'no2': np.sin(np.arange(1000) / 30.0), 'hch': np.cos(np.arange(1000) / 50.0)}
+        reduced = query_series(arrays, max_points=100)
+        assert len(reduced['date']) == 100
+        assert reduced['date'][0] == dates[0] and reduced['date'][-1] == dates[-1]
+        columnar = arrays_to_columnar(sliced)
+        assert columnar == {'date': ['2024-01-02'], 'no2': [5.0], 'hch': [0.7]}
+        packed = arrays_to_columnar(sliced, encoding='float32')
+        assert np.frombuffer(base64.b64decode(packed['no2']), dtype='<f4').tolist() == [5.0]
+        print(f"   Resultado: ✅ {len(reduced['date'])} puntos tras LTTB")
+
+        # Prueba 6: Niveles precalculados de la pirámide de agregados
+        print("\n6. Probando agregados por mes...")
+        monthly = series.query(agg='month')
+        assert list(monthly['no2']) == [3.0]
+        assert list(monthly['no2_min']) == [1.0] and list(monthly['no2_max']) == [5.0]
+        assert list(monthly['no2_count']) == [3]
+        assert len(series.query(agg='week')['date']) == 1
+        print(f"   Resultado: ✅ NO2 mensual = {monthly['no2'][0]}")
+
+        # Prueba 7: Formato de fecha detectado una vez por archivo
+        print("\n7. Probando detección de formato de fecha...")
+        assert _detect_schema(hch_path, 'hch')['date_format'] == '%y/%m/%d'
+        assert _detect_schema(no2_path, 'no2')['date_format'] == 'ISO8601'
+        assert _detect_date_format(pd.Series([1690000000, 1690003600])) == 'epoch:s'
+        print("   Resultado: ✅ AA/MM/DD, ISO y época detectados")
+
+        # Prueba 8: Series por zona desde la rejilla espacial
+        print("\n8. Probando consulta por región...")
+        zmvm = restarted.query_region(REGIONS['zmvm'])
+        assert list(zmvm['no2']) == [2.0, 5.0]
+        assert len(series.query_region(REGIONS['monterrey'])['date']) == 0
+        print(f"   Resultado: ✅ {len(zmvm['date'])} días en la ZMVM")
+
+        # Prueba 9: Filas añadidas al final se procesan de forma incremental
+        print("\n9. Probando ingestión incremental...")
+        calls = []
+        original = timeseries_manager._partials_csv_chunked
+
+        def spy(path, kind, chunksize=None, start=0, end=None):
+            calls.append(start)
+            return original(path, kind, chunksize, start, end)
+
+        timeseries_manager._partials_csv_chunked = spy
+        try:
+            with open(no2_path, 'a', encoding='utf-8') as f:
+                f.write('2024-01-02 11:00,19.4,-99.1,7.0\n')
+            daily = load_normalized_series(no2_path, 'no2')
+        finally:
+            timeseries_manager._partials_csv_chunked = original
+        assert calls and calls[0] > 0
+        assert list(daily['no2']) == [2.0, 6.0]
+        print(f"   Resultado: ✅ Solo se leyeron los bytes desde {calls[0]}")
+
+        # Prueba 10: Un cambio sirve el snapshot anterior y reconstruye en segundo plano
+        print("\n10. Probando revalidación en segundo plano...")
+        _write_csv(no2_path, [
+            ('2024-01-01 10:00', 19.4, -99.1, 10.0),
+            ('2024-01-02 10:00', 19.4, -99.1, 20.0),
+        ])
+        os.utime(no2_path, ns=(time.time_ns(), time.time_ns() + 1_000_000_000))
+        assert series.get() is first
+        series._refresh_thread.join(timeout=10)
+        data = series.get_data()
+        print(f"   Resultado: {'✅' if data[0]['no2'] == 10.0 else '❌'} NO2 = {data[0]['no2']}")
+        assert data[0]['no2'] == 10.0
+
+        # Prueba 11: Un contaminante nuevo se procesa en paralelo y se une a la serie
+        print("\n11. Probando registro de contaminantes...")
+        _write_csv(os.path.join(directory, 'datos_tempo_o3_completo.csv'), [
+            ('2024-01-03 10:00', 19.4, -99.1, 40.0),
+        ])
+        os.remove(no2_path + '.no2.npz')
+        partials = load_local_partials(directory, workers=2)
+        assert sorted(partials) == ['hch', 'no2', 'o3']
+        merged = TimeseriesManager(directory).query()
+        assert list(merged['o3'])[-1] == 40.0 and np.isnan(merged['no2'][-1])
+        columnar = arrays_to_columnar(merged)
+        assert columnar['o3'] == [None, None, 40.0]
+        print(f"   Resultado: ✅ {len(merged['date'])} días con NO2, HCHO y O3")
+
+        # Prueba 12: Varios fragmentos por contaminante en una subcarpeta
+        print("\n12. Probando fragmentos por contaminante...")
+        shard_dir = os.path.join(directory, 'o3')
+        os.mkdir(shard_dir)
+        _write_csv(os.path.join(shard_dir, '2024-01-03.csv'), [('2024-01-03 12:00', 19.4, -99.1, 60.0)])
+        _write_csv(os.path.join(shard_dir, '2024-01-04.csv'), [('2024-01-04 10:00', 19.4, -99.1, 30.0)])
+        sharded = TimeseriesManager(directory, workers=2).query()
+        assert list(sharded['o3'])[-2:] == [50.0, 30.0]
+        print(f"   Resultado: ✅ O3 = {list(sharded['o3'])[-2:]} combinando 3 fragmentos")
+
+        # Prueba 13: Almacén SQLite compartido entre procesos del servidor
+        print("\n13. Probando almacén persistente...")
+        store = TimeseriesStore(os.path.join(directory, 'timeseries.db'))
+        writer = TimeseriesManager(directory, store=store)
+        expected = writer.query(agg='week')
+        original = timeseries_manager.load_local_partials
+        timeseries_manager.load_local_partials = None  # otro proceso no debe leer los CSV
+        try:
+            reader = TimeseriesManager(directory, store=TimeseriesStore(store.db_name))
+            week = reader.query(agg='week')
+            zone = reader.query_region(REGIONS['zmvm'])
+        finally:
+            timeseries_manager.load_local_partials = original
+        assert all(np.array_equal(week[k], expected[k], equal_nan=True) for k in expected)
+        assert list(zone['o3'])[-1] == 30.0
+        print(f"   Resultado: ✅ {len(week['date'])} semanas leídas desde SQLite")
+
+        # Arranque en frío simultáneo: solo un proceso lee los CSV
+        ingests = []
+
+        def slow_ingest(*args):
+            ingests.append(args)
+            time.sleep(0.3)
+            return original(*args)
+
+        cold_db = os.path.join(directory, 'cold.db')
+        timeseries_manager.load_local_partials = slow_ingest
+        try:
+            workers = [threading.Thread(target=lambda: TimeseriesManager(directory, store=TimeseriesStore(cold_db)).get())
+                       for _ in range(3)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            timeseries_manager.load_local_partials = original
+        assert len(ingests) == 1
+        print(f"   Resultado: ✅ {len(ingests)} lectura de CSV para 3 arranques simultáneos")
+
+        # Una versión que solo añade horas escribe solo esas filas
+        def hourly_partials(hours):
+            index = pd.date_range('2020-01-01', periods=hours, freq='h', name='date')
+            values = np.arange(hours, dtype='float64')
+            return {'no2': {'hourly': pd.DataFrame({'sum': values, 'count': 1, 'min': values, 'max': values}, index=index),
+                            'cells': timeseries_manager._empty_cell_partials()}}
+
+        sync_store = TimeseriesStore(os.path.join(directory, 'sync.db'))
+        sync_store.write_local(hourly_partials(20000), 'v1')
+        with sqlite3.connect(sync_store.db_name) as conn:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        sync_store.write_local(hourly_partials(20001), 'v2')
+        wal_bytes = os.path.getsize(sync_store.db_name + '-wal')
+        sync_store.write_local(hourly_partials(10), 'v3')
+        stored = sync_store.read_partials('local')['no2']
+        assert wal_bytes < 64 * 1024 and len(stored) == 10 and stored['sum'].iloc[-1] == 9.0
+        print(f"   Resultado: ✅ {wal_bytes} bytes de WAL al añadir una hora a 20000")
+
+        # Prueba 14: Arreglos publicados en disco y mapeados en memoria
+        print("\n14. Probando arreglos mapeados en memoria...")
+        mmap_dir = os.path.join(directory, 'mmap')
+        first = TimeseriesManager(directory, store=store, mmap_dir=mmap_dir).get()
+        second = TimeseriesManager(directory, store=store, mmap_dir=mmap_dir).get()
+        day = second['levels']['day']
+        assert isinstance(day['no2'], np.memmap) and not day['no2'].flags.writeable
+        assert os.listdir(mmap_dir) == [second['version']]
+        sliced = query_series(day, start='2024-01-02', end='2024-01-03')
+        assert np.shares_memory(sliced['no2'], day['no2'])
+        assert arrays_to_columnar(sliced)['o3'] == arrays_to_columnar(query_series(first['levels']['day'], '2024-01-02', '2024-01-03'))['o3']
+        print(f"   Resultado: ✅ {len(os.listdir(os.path.join(mmap_dir, second['version'], 'levels')))} niveles compartidos")
+        # Una versión más nueva de otro proceso no se borra al publicar una vieja
+        races = os.path.join(directory, 'mmap_races')
+        levels = {'day': {'date': np.array(['2024-01-01'], dtype='datetime64[ns]')}}
+        slow_start = time.time() - 60
+        timeseries_manager._write_mapped_snapshot(races, 'nueva', levels, {})
+        timeseries_manager._write_mapped_snapshot(races, 'vieja', levels, {}, started=slow_start)
+        assert sorted(os.listdir(races)) == ['nueva', 'vieja']
+        # Carpeta temporal abandonada por una construcción interrumpida y otra en curso
+        abandoned = os.path.join(races, '.rota.abc123')
+        os.makedirs(abandoned)
+        old_time = time.time() - timeseries_manager.STALE_BUILD_AGE - 60
+        os.utime(abandoned, (old_time, old_time))
+        os.makedirs(os.path.join(races, '.en_curso.def456'))
+        timeseries_manager._write_mapped_snapshot(races, 'actual', levels, {}, started=time.time() + 1)
+        assert sorted(os.listdir(races)) == ['.en_curso.def456', 'actual']
+
+        # Prueba 15: Subida procesada por bloques sin conservar las filas
+        print("\n15. Probando lectura por bloques de una subida...")
+        upload_path = os.path.join(directory, 'subida.txt')
+        with open(upload_path, 'w', encoding='utf-8') as f:
+            f.write('fecha,NO2,ozono\n2024-03-01,1.0,\n2024-03-01,3.0,9.0\n2024-03-02,,\n')
+        progress = []
+        result = load_upload_partials(upload_path, chunksize=1, progress=lambda b, rows: progress.append(rows))
+        summary = partials_summary(result['partials'])
+        assert progress == [1, 2, 3] and (result['rows'], result['valid_rows']) == (3, 2)
+        assert summary['no2']['mean'] == 2.0 and summary['o3']['count'] == 1
+        print(f"   Resultado: ✅ {result['valid_rows']} de {result['rows']} filas válidas")
+
+        # Prueba 16: Correcciones subidas combinadas con la serie local
+        print("\n16. Probando correcciones subidas...")
+        before = TimeseriesManager(directory, store=store).query()
+        store.write_upload({'date': np.array(['2024-01-01', '2024-01-03 15:00', '2024-02-01'], dtype='datetime64[ns]'),
+                            'no2': np.array([100.0, 4.0, 7.0])})
+        store.write_upload({'date': np.array(['2024-01-02'], dtype='datetime64[ns]'),
+                            'no2': np.array([8.0])}, mode='average')
+        assert store.overrides_version() == '2'
+        corrected = TimeseriesManager(directory, store=store)
+        day = corrected.query()
+        assert list(day['no2'][:2]) == [100.0, (before['no2'][1] + 8.0) / 2]
+        assert list(day['no2'][-1:]) == [7.0] and day['no2'][2] == 4.0
+        hourly = corrected.query(agg='hour')['no2']
+        assert hourly[~np.isnan(hourly)][0] == 10.0
+        os.utime(no2_path, ns=(time.time_ns(), time.time_ns() + 2_000_000_000))
+        assert corrected.refresh()['levels']['day']['no2'][0] == 100.0
+        print(f"   Resultado: ✅ NO2 corregido = {list(day['no2'][:2])}")
+
+        # Prueba 17: Un CSV sin salto de línea final no pierde su última fila
+        print("\n17. Probando CSV sin salto de línea final...")
+        tail_path = os.path.join(directory, 'sin_salto.csv')
+        with open(tail_path, 'w', encoding='utf-8') as f:
+            f.write('time,value\n2024-01-01 10:00,1\n2024-01-02 10:00,5')
+        first = load_normalized_series(tail_path, 'no2')
+        # Lo añadido completa la última fila: se reconstruye en lugar de sumar
+        with open(tail_path, 'a', encoding='utf-8') as f:
+            f.write('.5\n2024-01-03 10:00,2\n')
+        second = load_normalized_series(tail_path, 'no2')
+        assert list(first['no2']) == [1.0, 5.0]
+        assert list(second['no2']) == [1.0, 5.5, 2.0]
+        print(f"   Resultado: ✅ {len(first)} días sin salto final, {list(second['no2'])} tras completar la fila")
+
+        # Prueba 18: Los huecos no atraen la selección de LTTB
+        print("\n18. Probando LTTB con huecos...")
+        values = 1e16 + np.random.default_rng(0).normal(0, 1e14, 700)
+        values[3::7] = np.nan
+        picked = lttb_indices(np.arange(700), values, 48)
+        gaps = int(np.isnan(values[picked]).sum())
+        assert gaps == 0
+        print(f"   Resultado: ✅ {gaps} de {len(picked)} puntos elegidos en huecos")
+
+        # Prueba 19: Una corrección nueva no vuelve a leer la serie completa
+        print("\n19. Probando corrección incremental...")
+        mapped_dir = os.path.join(directory, 'mmap_overrides')
+        patched = TimeseriesManager(directory, store=store, mmap_dir=mapped_dir)
+        old = patched.get()
+        old_version, old_hour = old['version'], np.array(old['levels']['hour']['no2'])
+        read_cells, read_local = store.read_cells, store.read_local
+        store.read_cells = store.read_local = None  # no deben usarse
+        try:
+            store.write_upload({'date': np.array(['2024-01-02'], dtype='datetime64[ns]'),
+                                'no2': np.array([50.0])})
+            snapshot = patched.refresh()
+        finally:
+            store.read_cells, store.read_local = read_cells, read_local
+        day = snapshot['levels']['day']
+        assert snapshot['version'] != old_version and day['no2'][1] == 50.0
+        assert np.array_equal(snapshot['levels']['hour']['no2'], old_hour, equal_nan=True) and snapshot['cells']
+        assert os.path.exists(os.path.join(mapped_dir, snapshot['version'], 'levels', 'hour', 'date.npy'))
+        print(f"   Resultado: ✅ NO2 del 2024-01-02 = {day['no2'][1]} sin releer acumuladores ni celdas")
+    finally:
+        shutil.rmtree(directory)
+
+    print("\n🎉 Pruebas completadas!")
+
+
+if __name__ == "__main__":
+    test_timeseries_cache()
@@ -0,0 +1,1214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ingestión y caché de las series temporales locales (NO2 + HCHO) de TEMPO
+"""
+
+import os
+import io
+import json
+import shutil
+import tempfile
+import base64
+import hashlib
+import threading
+import logging
+import multiprocessing
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from typing import Optional, List
+
+# Versión del formato de caché en disco; incrementarla invalida los .npz existentes
+CACHE_VERSION = 5
+
+# Registro de contaminantes: nombre -> patrones en el nombre del CSV, palabras
+# clave de la columna de valor y nombres de columna aceptados en subidas manuales
+POLLUTANTS = {
+    'no2': {
+        'file_patterns': ['no2'],
+        'keywords': ['no2'],
+        'upload_columns': ['no2'],
+    },
+    'hch': {
+        'file_patterns': ['hch', 'hcho', 'formaldeh'],
+        'keywords': ['hch', 'hcho', 'formaldeh'],
+        'upload_columns': ['hch', 'hcho', 'formaldehido', 'formaldehído', 'formaldehyde'],
+    },
+    'o3': {
+        'file_patterns': ['o3', 'ozono', 'ozone'],
+        'keywords': ['o3', 'ozono', 'ozone'],
+        'upload_columns': ['o3', 'ozono', 'ozone'],
+    },
+    'ai': {
+        'file_patterns': ['aerosol', 'uvai'],
+        'keywords': ['aerosol', 'uvai'],
+        'upload_columns': ['ai', 'aerosol', 'aerosol_index', 'uvai'],
+    },
+}
+
+# Nombres aceptados para la columna de fecha en subidas manuales
+UPLOAD_DATE_COLUMNS = ('date', 'fecha', 'dia', 'fecha_hora')
+
+# Cómo se combina una corrección subida con el valor que ya existe para ese día
+OVERRIDE_MODES = ('replace', 'average')
+
+# Resultados de TimeseriesStore.claim_ingest y segundos entre consultas
+# mientras otro proceso lee los CSV
+INGEST_DONE = 'done'
+INGEST_CLAIMED = 'claimed'
+INGEST_BUSY = 'busy'
+INGEST_POLL_INTERVAL = 0.5
+
+# Sufijos de las columnas de estadísticas que acompañan a cada contaminante
+STAT_SUFFIXES = ('_min', '_max', '_count')
+
+# Niveles de la pirámide de agregados, del más fino al más grueso
+ROLLUP_LEVELS = ('hour', 'day', 'week', 'month')
+
+# Unidad NumPy con que se serializan las fechas de cada nivel ('2023-08-02T10:00', '2023-08-02', '2023-08')
+LEVEL_DATE_UNITS = {'hour': 'm', 'day': 'D', 'week': 'D', 'month': 'M'}
+
+# Cómo se combinan los acumuladores parciales de un mismo periodo
+PARTIAL_AGG = {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'}
+
+# Filas de muestra usadas para detectar columnas y formato de fecha
+SNIFF_ROWS = 200
+
+# Formatos de fecha candidatos, en orden de preferencia (AA/MM/DD antes que DD/MM/AA)
+DATE_FORMATS = [
+    'ISO8601',
+    '%y/%m/%d', '%y/%m/%d %H:%M', '%y/%m/%d %H:%M:%S',
+    '%Y/%m/%d', '%Y/%m/%d %H:%M', '%Y/%m/%d %H:%M:%S',
+    '%d/%m/%Y', '%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S',
+    '%m/%d/%Y', '%m/%d/%Y %H:%M', '%m/%d/%Y %H:%M:%S',
+]
+
+# Magnitud mínima de una marca numérica para cada unidad de época
+EPOCH_UNITS = [(1e17, 'ns'), (1e14, 'us'), (1e11, 'ms'), (1e8, 's')]
+
+# Esquema detectado por archivo: {(ruta, kind): {'header', 'date_col', 'val_col', 'date_format'}}
+_schema_cache = {}
+_schema_lock = threading.Lock()
+
+# Filas por bloque al leer CSV grandes en streaming (None lee el archivo completo)
+CHUNK_SIZE = 200_000
+
+# Bytes previos a la última posición procesada que se comparan para detectar reescrituras
+TAIL_HASH_BYTES = 4096
+
+# Bloques acumulados antes de combinarlos en un único parcial
+COMBINE_EVERY = 8
+
+# Segundos sin cambios tras los que una carpeta temporal de una versión
+# mapeada se da por abandonada (construcción interrumpida) y se borra
+STALE_BUILD_AGE = 600
+
+# Tamaño en grados de las celdas de la rejilla espacial
+GRID_DEGREES = 0.5
+GRID_ROWS = int(round(180 / GRID_DEGREES))
+GRID_COLS = int(round(360 / GRID_DEGREES))
+
+# Zonas con nombre para ?region=, como (min_lon, min_lat, max_lon, max_lat)
+REGIONS = {
+    'norteamerica': (-170.0, 10.0, -50.0, 75.0),
+    'mexico': (-118.5, 14.5, -86.5, 32.8),
+    'zmvm': (-99.4, 19.0, -98.8, 19.8),
+    'guadalajara': (-103.6, 20.4, -103.1, 20.9),
+    'monterrey': (-100.6, 25.4, -100.0, 25.9),
+}
+
+
+def _find_date_column(df: pd.DataFrame) -> Optional[str]:
+    candidates = ['date', 'fecha', 'dia', 'fecha_hora', 'timestamp', 'time']
+    lower_map = {c.lower().strip(): c for c in df.columns}
+    for k in candidates:
+        if k in lower_map:
+            return lower_map[k]
+    # fallback: try infer by dtype
+    for c in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[c]):
+            return c
+    # fallback: detect textual dates like '23/08/02' or '2023-08-02' with a known format
+    sample = df.head(SNIFF_ROWS)
+    for c in df.columns:
+        if pd.api.types.is_string_dtype(df[c]) and _detect_date_format(sample[c]) is not None:
+            return c
+    return None
+
+
+def _find_value_column(df: pd.DataFrame, keywords: List[str]) -> Optional[str]:
+    lower_map = {c.lower().strip(): c for c in df.columns}
+    for k in keywords + ['value']:
+        for key in list(lower_map.keys()):
+            if k in key:
+                return lower_map[key]
+    # fallback: first numeric column excluding date
+    for c in df.columns:
+        if pd.api.types.is_numeric_dtype(df[c]):
+            return c
+    return None
+
+
+def _find_coord_columns(df: pd.DataFrame) -> (Optional[str], Optional[str]):
+    """Detecta las columnas de latitud y longitud (None si falta alguna)"""
+    lower_map = {c.lower().strip(): c for c in df.columns}
+    lat_col = next((lower_map[k] for k in ('lat', 'latitude', 'latitud') if k in lower_map), None)
+    lon_col = next((lower_map[k] for k in ('lon', 'lng', 'long', 'longitude', 'longitud') if k in lower_map), None)
+    if lat_col is None or lon_col is None:
+        return None, None
+    return lat_col, lon_col
+
+
+def register_pollutant(name: str, file_patterns: List[str], keywords: List[str],
+                       upload_columns: Optional[List[str]] = None):
+    """Agrega (o reemplaza) un contaminante en el registro"""
+    POLLUTANTS[name] = {
+        'file_patterns': [p.lower() for p in file_patterns],
+        'keywords': [k.lower() for k in keywords],
+        'upload_columns': [c.lower() for c in (upload_columns or [name])],
+    }
+
+
+def _resolve_columns(df: pd.DataFrame, kind: str) -> (str, str):
+    """Detecta las columnas de fecha y valor para el contaminante indicado"""
+    date_col = _find_date_column(df)
+    if date_col is None:
+        raise ValueError('No se encontró columna de fecha')
+    if kind not in POLLUTANTS:
+        raise ValueError(f'Contaminante no registrado: {kind}')
+    val_col = _find_value_column(df, POLLUTANTS[kind]['keywords'])
+    if val_col is None:
+        raise ValueError(f'No se encontró columna de valor para {kind}')
+    return date_col, val_col
+
+
+def _detect_date_format(sample: pd.Series) -> Optional[str]:
+    """
+    Decide a partir de una muestra el formato exacto de la columna de fecha:
+    'datetime' si ya viene convertida, 'epoch:<unidad>' para marcas numéricas
+    o un formato de DATE_FORMATS. Devuelve None si ninguno encaja.
+    """
+    values = sample.dropna()
+    if values.empty:
+        return None
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return 'datetime'
+    if pd.api.types.is_numeric_dtype(values):
+        magnitude = values.abs().median()
+        for threshold, unit in EPOCH_UNITS:
+            if magnitude >= threshold:
+                return f'epoch:{unit}'
+        return None
+    values = values.astype(str).str.strip()
+    best, best_ratio = None, 0.5
+    for fmt in DATE_FORMATS:
+        ratio = pd.to_datetime(values, format=fmt, errors='coerce').notna().mean()
+        if ratio == 1.0:
+            return fmt
+        if ratio > best_ratio:
+            best, best_ratio = fmt, ratio
+    return best
+
+
+def _parse_dates(raw: pd.Series, date_format: Optional[str] = None) -> pd.Series:
+    """Convierte la columna de fecha con un único formato explícito y vectorizado"""
+    if date_format is None:
+        date_format = _detect_date_format(raw.head(SNIFF_ROWS))
+    if date_format == 'datetime':
+        parsed = raw
+    elif date_format and date_format.startswith('epoch:'):
+        parsed = pd.to_datetime(pd.to_numeric(raw, errors='coerce'), unit=date_format.split(':', 1)[1], errors='coerce')
+    elif date_format:
+        parsed = pd.to_datetime(raw, format=date_format, errors='coerce')
+    else:
+        # Último recurso: inferencia elemento por elemento
+        parsed = pd.to_datetime(raw, errors='coerce')
+    if getattr(parsed.dt, 'tz', None) is not None:
+        parsed = parsed.dt.tz_convert(None)
+    return parsed
+
+
+def _detect_schema(path: str, kind: str) -> dict:
+    """
+    Detecta (una sola vez por archivo) las columnas de fecha, valor y
+    coordenadas y el formato de fecha. Se vuelve a detectar solo si cambia el encabezado.
+    """
+    key = (os.path.abspath(path), kind)
+    header = tuple(pd.read_csv(path, nrows=0).columns)
+    with _schema_lock:
+        cached = _schema_cache.get(key)
+    if cached is not None and cached['header'] == header:
+        return cached
+    sample = pd.read_csv(path, nrows=SNIFF_ROWS)
+    date_col, val_col = _resolve_columns(sample, kind)
+    lat_col, lon_col = _find_coord_columns(sample)
+    schema = {
+        'header': header,
+        'date_col': date_col,
+        'val_col': val_col,
+        'lat_col': lat_col,
+        'lon_col': lon_col,
+        'date_format': _detect_date_format(sample[date_col]),
+    }
+    with _schema_lock:
+        _schema_cache[key] = schema
+    return schema
+
+
+def _empty_partials() -> pd.DataFrame:
+    return pd.DataFrame({'sum': pd.Series(dtype='float64'), 'count': pd.Series(dtype='int64'),
+                         'min': pd.Series(dtype='float64'), 'max': pd.Series(dtype='float64')},
+                        index=pd.DatetimeIndex([], name='date'))
+
+
+def _empty_cell_partials() -> pd.DataFrame:
+    index = pd.MultiIndex.from_arrays([np.array([], dtype='int64'), pd.DatetimeIndex([])], names=['cell', 'date'])
+    return _empty_partials().set_index(index)
+
+
+def _cell_ids(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Identificador de la celda de la rejilla regular que contiene cada punto"""
+    rows = np.clip(np.floor((lat + 90.0) / GRID_DEGREES), 0, GRID_ROWS - 1).astype(np.int64)
+    cols = np.clip(np.floor((lon + 180.0) / GRID_DEGREES), 0, GRID_COLS - 1).astype(np.int64)
+    return rows * GRID_COLS + cols
+
+
+def _group_partials(values: pd.Series, keys: list, empty) -> pd.DataFrame:
+    if values.empty:
+        return empty()
+    return values.groupby(keys).agg(['sum', 'count', 'min', 'max'])
+
+
+def _chunk_partials(df: pd.DataFrame, schema: dict) -> dict:
+    """
+    Reduce un bloque de filas a acumuladores (suma, conteo, mínimo y máximo)
+    que se pueden combinar entre bloques sin conservar las filas:
+    'hourly' por hora para toda la zona y, si hay coordenadas, 'cells' por
+    celda de la rejilla y día.
+    """
+    dates = _parse_dates(df[schema['date_col']], schema.get('date_format'))
+    values = pd.to_numeric(df[schema['val_col']], errors='coerce')
+    valid = dates.notna() & values.notna()
+    dates, values = dates[valid], values[valid]
+    hourly = _group_partials(values, [dates.dt.floor('h').rename('date')], _empty_partials)
+
+    cells = _empty_cell_partials()
+    if schema.get('lat_col') and schema.get('lon_col'):
+        lat = pd.to_numeric(df.loc[valid, schema['lat_col']], errors='coerce')
+        lon = pd.to_numeric(df.loc[valid, schema['lon_col']], errors='coerce')
+        located = lat.notna() & lon.notna()
+        cell = pd.Series(_cell_ids(lat[located].to_numpy(), lon[located].to_numpy()),
+                         index=lat.index[located], name='cell')
+        cells = _group_partials(values[located], [cell, dates[located].dt.normalize().rename('date')],
+                                _empty_cell_partials)
+    return {'hourly': hourly, 'cells': cells}
+
+
+def _hourly_partials(df: pd.DataFrame, date_col: str, val_col: str,
+                     date_format: Optional[str] = None) -> pd.DataFrame:
+    """Acumuladores por hora de un bloque de filas, sin desglose espacial"""
+    schema = {'date_col': date_col, 'val_col': val_col, 'date_format': date_format}
+    return _chunk_partials(df, schema)['hourly']
+
+
+def _combine_partials(frames: List[pd.DataFrame], empty=_empty_partials) -> pd.DataFrame:
+    """Combina acumuladores parciales con el mismo índice (fecha o celda y fecha)"""
+    frames = [f for f in frames if f is not None and not f.empty]
+    if not frames:
+        return empty()
+    if len(frames) == 1:
+        return frames[0]
+    combined = pd.concat(frames)
+    return combined.groupby(level=list(range(combined.index.nlevels))).agg(PARTIAL_AGG)
+
+
+def _combine_file_partials(parts: List[dict]) -> dict:
+    return {
+        'hourly': _combine_partials([p['hourly'] for p in parts]),
+        'cells': _combine_partials([p['cells'] for p in parts], _empty_cell_partials),
+    }
+
+
+def _level_key(index: pd.DatetimeIndex, level: str) -> pd.DatetimeIndex:
+    """Fecha de inicio del periodo (hora, día, semana ISO o mes) de cada marca"""
+    if level == 'hour':
+        return index
+    if level == 'day':
+        return index.normalize()
+    if level == 'week':
+        return (index - pd.to_timedelta(index.dayofweek, unit='D')).normalize()
+    if level == 'month':
+        return index.to_period('M').to_timestamp()
+    raise ValueError(f'Nivel de agregación desconocido: {level}')
+
+
+def rollup_partials(partials: pd.DataFrame, level: str) -> pd.DataFrame:
+    """Agrupa los acumuladores horarios en el nivel pedido"""
+    if level == 'hour' or partials.empty:
+        return partials
+    keys = _level_key(partials.index, level).rename('date')
+    return partials.groupby(keys).agg(PARTIAL_AGG)
+
+
+def _finalize_partials(partials: pd.DataFrame, kind: str) -> pd.DataFrame:
+    """Convierte los acumuladores en la serie ['date', kind] con el promedio por periodo"""
+    out = (partials['sum'] / partials['count']).rename(kind).sort_index()
+    out = out.reset_index()
+    out['date'] = out['date'].astype('datetime64[ns]')
+    return out
+
+
+def _normalize_single(df: pd.DataFrame, kind: str) -> pd.DataFrame:
+    """
+    kind: a name registered in POLLUTANTS ('no2', 'hch', 'o3', 'ai', ...)
+    Returns a dataframe with columns ['date', kind]
+    """
+    date_col, val_col = _resolve_columns(df, kind)
+    return _finalize_partials(rollup_partials(_hourly_partials(df, date_col, val_col), 'day'), kind)
+
+
+class _ByteRange(io.RawIOBase):
+    """Vista de solo lectura sobre los bytes [start, end) de un archivo abierto"""
+
+    def __init__(self, f, start: int, end: int):
+        f.seek(start)
+        self._f = f
+        self._left = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self._left)
+        if n <= 0:
+            return 0
+        data = self._f.read(n)
+        buffer[:len(data)] = data
+        self._left -= len(data)
+        return len(data)
+
+
+def _tail_hash(path: str, offset: int) -> str:
+    """Huella de los bytes previos a offset, para detectar archivos reescritos"""
+    with open(path, 'rb') as f:
+        start = max(0, offset - TAIL_HASH_BYTES)
+        f.seek(start)
+        return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+
+def _partials_csv_chunked(path: str, kind: str, chunksize: Optional[int] = CHUNK_SIZE,
+                          start: int = 0, end: Optional[int] = None) -> dict:
+    """
+    Lee los bytes [start, end) del CSV por bloques y acumula suma/conteo/mín/máx
+    por hora (y por celda y día), de modo que la memoria depende del número de
+    periodos y celdas distintos y no del número de filas. Con start > 0 se
+    leen solo filas añadidas, sin encabezado.
+    """
+    schema = _detect_schema(path, kind)
+    usecols = [c for c in (schema['date_col'], schema['val_col'], schema['lat_col'], schema['lon_col']) if c]
+    end = os.path.getsize(path) if end is None else end
+    if end <= start:
+        return _combine_file_partials([])
+    if start > 0:
+        header = {'header': None, 'names': list(schema['header'])}
+    else:
+        header = {'header': 0}
+    pending = []
+    with open(path, 'rb') as f:
+        reader = pd.read_csv(io.BufferedReader(_ByteRange(f, start, end)), usecols=usecols,
+                             chunksize=chunksize, **header)
+        for chunk in (reader if chunksize else [reader]):
+            pending.append(_chunk_partials(chunk, schema))
+            # Se combinan por lotes para no reagrupar el total en cada bloque
+            if len(pending) >= COMBINE_EVERY:
+                pending = [_combine_file_partials(pending)]
+    return _combine_file_partials(pending)
+
+
+def _normalize_csv_chunked(path: str, kind: str, chunksize: int = CHUNK_SIZE) -> pd.DataFrame:
+    """Variante en streaming de _normalize_single a partir de la ruta del CSV"""
+    return _finalize_partials(rollup_partials(_partials_csv_chunked(path, kind, chunksize)['hourly'], 'day'), kind)
+
+
+def _match_pollutant(name: str) -> Optional[str]:
+    """Primer contaminante del registro cuyo patrón aparece en el nombre"""
+    name = name.lower()
+    for kind, spec in POLLUTANTS.items():
+        if any(p in name for p in spec['file_patterns']):
+            return kind
+    return None
+
+
+def _scan_for_files(directory: str = '.') -> dict:
+    """
+    Fragmentos CSV de cada contaminante registrado: {kind: [rutas]}. Se toman
+    los CSV del directorio cuyo nombre coincide con un contaminante y todos
+    los CSV dentro de subcarpetas cuyo nombre coincide (p. ej. no2/2024-01-01.csv).
+    """
+    found = {}
+    for entry in sorted(os.listdir(directory)):
+        path = os.path.join(directory, entry)
+        kind = _match_pollutant(entry)
+        if kind is None:
+            continue
+        if os.path.isdir(path):
+            shards = [os.path.join(root, f)
+                      for root, _, names in os.walk(path)
+                      for f in names if f.lower().endswith('.csv')]
+        elif entry.lower().endswith('.csv'):
+            shards = [path]
+        else:
+            continue
+        found.setdefault(kind, []).extend(shards)
+    return {kind: sorted(paths) for kind, paths in found.items() if paths}
+
+
+def _file_fingerprint(path: str) -> tuple:
+    """Identifica una versión de archivo por ruta, tamaño y fecha de modificación"""
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+
+def _snapshot_version(fingerprint) -> str:
+    """Identificador estable de una versión de los datos, usado como ETag"""
+    return hashlib.sha1(repr((CACHE_VERSION, fingerprint)).encode()).hexdigest()[:16]
+
+
+def _cache_path(path: str, kind: str) -> str:
+    return f"{path}.{kind}.npz"
+
+
+def _read_cached_partials(path: str, kind: str) -> Optional[dict]:
+    """
+    Lee los acumuladores en caché junto con la huella y la posición hasta la
+    que se procesó el CSV (None si no existe o es de otra versión de formato).
+    """
+    cache_path = _cache_path(path, kind)
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cached:
+            if int(cached['version']) != CACHE_VERSION:
+                return None
+            hourly = pd.DataFrame({c: cached[c] for c in PARTIAL_AGG},
+                                  index=pd.DatetimeIndex(cached['date'], name='date'))
+            cell_index = pd.MultiIndex.from_arrays([cached['cell_id'], pd.DatetimeIndex(cached['cell_date'])],
+                                                   names=['cell', 'date'])
+            cells = pd.DataFrame({c: cached[f'cell_{c}'] for c in PARTIAL_AGG}, index=cell_index)
+            return {
+                'hourly': hourly,
+                'cells': cells,
+                'size': int(cached['size']),
+                'mtime_ns': int(cached['mtime_ns']),
+                'offset': int(cached['offset']),
+                'header': tuple(cached['header'].tolist()),
+                'tail_hash': str(cached['tail_hash']),
+            }
+    except Exception as e:
+        logging.warning(f"Caché inválida {cache_path}: {e}")
+        return None
+
+
+def _write_cached_partials(path: str, kind: str, partials: dict, fingerprint: tuple,
+                           offset: int, header: tuple):
+    """Guarda los acumuladores junto al CSV, etiquetados con su huella y la posición procesada"""
+    cache_path = _cache_path(path, kind)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    _, size, mtime_ns = fingerprint
+    hourly, cells = partials['hourly'], partials['cells']
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     version=CACHE_VERSION,
+                     size=size,
+                     mtime_ns=mtime_ns,
+                     offset=offset,
+                     header=np.array(header, dtype=str),
+                     tail_hash=_tail_hash(path, offset),
+                     date=hourly.index.to_numpy(dtype='datetime64[ns]'),
+                     cell_id=cells.index.get_level_values('cell').to_numpy(dtype='int64'),
+                     cell_date=cells.index.get_level_values('date').to_numpy(dtype='datetime64[ns]'),
+                     **{c: hourly[c].to_numpy() for c in PARTIAL_AGG},
+                     **{f'cell_{c}': cells[c].to_numpy() for c in PARTIAL_AGG})
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"No se pudo escribir la caché {cache_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _is_fresh(cached: Optional[dict], fingerprint: tuple) -> bool:
+    """True si la caché corresponde exactamente a la versión actual del CSV"""
+    _, size, mtime_ns = fingerprint
+    return cached is not None and cached['size'] == size and cached['mtime_ns'] == mtime_ns
+
+
+def _is_append(path: str, cached: dict, size: int, header: tuple) -> bool:
+    """
+    True si el CSV solo creció por el final desde que se generó la caché y
+    la lectura anterior terminó en un salto de línea. Si terminó a mitad de
+    una fila (sin '\\n' final o en plena escritura) lo añadido podría
+    completar esa fila, así que se reconstruye completo.
+    """
+    offset = cached['offset']
+    if size < offset or header != cached['header'] or _tail_hash(path, offset) != cached['tail_hash']:
+        return False
+    with open(path, 'rb') as f:
+        f.seek(max(0, offset - 1))
+        return offset == 0 or f.read(1) == b'\n'
+
+
+def load_partials(path: str, kind: str, chunksize: Optional[int] = CHUNK_SIZE) -> dict:
+    """
+    Devuelve los acumuladores de un CSV ({'hourly': ..., 'cells': ...}),
+    usando la caché .npz. Si el archivo solo recibió filas nuevas al final,
+    se procesan únicamente esos bytes; si se truncó o reescribió, se
+    reconstruye completo.
+    """
+    fingerprint = _file_fingerprint(path)
+    _, size, mtime_ns = fingerprint
+    cached = _read_cached_partials(path, kind)
+    if _is_fresh(cached, fingerprint):
+        return {'hourly': cached['hourly'], 'cells': cached['cells']}
+
+    schema = _detect_schema(path, kind)
+    # Siempre hasta el final: una última fila sin '\n' también cuenta
+    end = size
+    if cached is not None and _is_append(path, cached, size, schema['header']):
+        tail = _partials_csv_chunked(path, kind, chunksize, start=cached['offset'], end=end)
+        partials = _combine_file_partials([cached, tail])
+    else:
+        partials = _partials_csv_chunked(path, kind, chunksize, start=0, end=end)
+    _write_cached_partials(path, kind, partials, fingerprint, end, schema['header'])
+    return partials
+
+
+def load_normalized_series(path: str, kind: str, chunksize: Optional[int] = CHUNK_SIZE) -> pd.DataFrame:
+    """Devuelve la serie diaria ['date', kind] de un CSV"""
+    return _finalize_partials(rollup_partials(load_partials(path, kind, chunksize)['hourly'], 'day'), kind)
+
+
+def _empty_arrays(columns: List[str]) -> dict:
+    arrays = {'date': np.array([], dtype='datetime64[ns]')}
+    arrays.update({c: np.array([], dtype='float64') for c in columns})
+    return arrays
+
+
+def _merge_kinds(partials_by_kind: dict, level: str) -> dict:
+    """
+    Agrupa los acumuladores de cada contaminante en el nivel pedido y los une
+    en un diccionario de arreglos contiguos: date, <kind> (promedio) y
+    <kind>_min, <kind>_max, <kind>_count. Las fechas son la unión de las de
+    todos los contaminantes; donde falta uno, su promedio es NaN.
+    """
+    merged = None
+    for kind, partials in partials_by_kind.items():
+        rolled = rollup_partials(partials, level)
+        frame = pd.DataFrame({
+            kind: rolled['sum'] / rolled['count'],
+            f'{kind}_min': rolled['min'],
+            f'{kind}_max': rolled['max'],
+            f'{kind}_count': rolled['count'],
+        })
+        merged = frame if merged is None else merged.join(frame, how='outer')
+    if merged is None:
+        return _empty_arrays([])
+    merged = merged.sort_index()
+    count_cols = [c for c in merged.columns if c.endswith('_count')]
+    merged[count_cols] = merged[count_cols].fillna(0)
+    arrays = {'date': np.ascontiguousarray(merged.index.to_numpy(dtype='datetime64[ns]'))}
+    for c in merged.columns:
+        dtype = 'int64' if c.endswith('_count') else 'float64'
+        arrays[c] = np.ascontiguousarray(merged[c].to_numpy(dtype=dtype))
+    return arrays
+
+
+def apply_overrides(daily_by_kind: dict, overrides: dict) -> dict:
+    """
+    Combina las correcciones diarias subidas con los acumuladores diarios
+    locales. En los días con corrección 'replace' se usa solo la corrección;
+    con 'average' el promedio del día es la media entre el valor local y el
+    corregido. Los días sin datos locales toman la corrección tal cual.
+    """
+    result = dict(daily_by_kind)
+    for kind, override in overrides.items():
+        local = result.get(kind, _empty_partials())
+        patch = override[list(PARTIAL_AGG)].copy()
+        existing = local.reindex(patch.index)
+        average = (override['mode'] == 'average') & existing['count'].notna()
+        if average.any():
+            ex, ov = existing[average], patch[average]
+            count = ex['count'] + ov['count']
+            patch.loc[average, 'sum'] = (ex['sum'] / ex['count'] + ov['sum'] / ov['count']) / 2 * count
+            patch.loc[average, 'count'] = count
+            patch.loc[average, 'min'] = np.minimum(ex['min'], ov['min'])
+            patch.loc[average, 'max'] = np.maximum(ex['max'], ov['max'])
+        combined = pd.concat([local.drop(patch.index, errors='ignore'), patch]).sort_index()
+        result[kind] = combined.astype({'count': 'int64'})
+    return result
+
+
+def daily_levels(daily_by_kind: dict, overrides: Optional[dict] = None) -> dict:
+    """
+    Niveles día, semana y mes a partir de los acumuladores diarios locales.
+    Las correcciones subidas se aplican sobre los días, y semana y mes se
+    agrupan desde los días ya corregidos; el nivel horario (que se arma
+    aparte) conserva los datos locales sin corregir.
+    """
+    if overrides:
+        daily_by_kind = apply_overrides(daily_by_kind, overrides)
+    return {level: _merge_kinds(daily_by_kind, level) for level in ROLLUP_LEVELS if level != 'hour'}
+
+
+def build_cell_index(cells: pd.DataFrame) -> dict:
+    """
+    Índice espacial: acumuladores diarios por celda como arreglos contiguos
+    ordenados por (celda, fecha), de modo que las celdas de cada fila de la
+    rejilla ocupan un tramo contiguo localizable con búsqueda binaria.
+    """
+    cells = cells.sort_index()
+    index = {
+        'cell': np.ascontiguousarray(cells.index.get_level_values('cell').to_numpy(dtype='int64')),
+        'date': np.ascontiguousarray(cells.index.get_level_values('date').to_numpy(dtype='datetime64[ns]')),
+    }
+    for c in PARTIAL_AGG:
+        index[c] = np.ascontiguousarray(cells[c].to_numpy())
+    return index
+
+
+def parse_bbox(text: str) -> tuple:
+    """Convierte 'min_lon,min_lat,max_lon,max_lat' en una tupla validada"""
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in text.split(','))
+    except ValueError:
+        raise ValueError('bbox debe ser min_lon,min_lat,max_lon,max_lat')
+    if not (-180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError('bbox fuera de rango o con mínimos mayores que máximos')
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def region_partials(index: dict, bbox: tuple) -> pd.DataFrame:
+    """Suma los acumuladores diarios de las celdas que intersectan la caja"""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    first = _cell_ids(np.array([min_lat]), np.array([min_lon]))[0]
+    last = _cell_ids(np.array([max_lat]), np.array([max_lon]))[0]
+    row0, col0 = divmod(first, GRID_COLS)
+    row1, col1 = divmod(last, GRID_COLS)
+    slices = []
+    for row in range(row0, row1 + 1):
+        lo = np.searchsorted(index['cell'], row * GRID_COLS + col0, side='left')
+        hi = np.searchsorted(index['cell'], row * GRID_COLS + col1, side='right')
+        if hi > lo:
+            slices.append(np.arange(lo, hi))
+    if not slices:
+        return _empty_partials()
+    positions = np.concatenate(slices)
+    selected = pd.DataFrame({c: index[c][positions] for c in PARTIAL_AGG},
+                            index=pd.DatetimeIndex(index['date'][positions], name='date'))
+    return selected.groupby(level=0).agg(PARTIAL_AGG)
+
+
+def resolve_upload_columns(columns) -> (Optional[str], dict):
+    """Columna de fecha y {kind: columna} de un CSV subido manualmente"""
+    cols = {str(c).lower().strip(): c for c in columns}
+    date_col = next((cols[k] for k in cols if k in UPLOAD_DATE_COLUMNS), None)
+    value_cols = {}
+    for kind, spec in POLLUTANTS.items():
+        col = next((cols[k] for k in cols if k in spec['upload_columns']), None)
+        if col is not None:
+            value_cols[kind] = col
+    return date_col, value_cols
+
+
+def load_upload_partials(path: str, chunksize: Optional[int] = CHUNK_SIZE, progress=None) -> dict:
+    """
+    Lee por bloques un CSV subido manualmente (fecha y una columna por
+    contaminante) y lo reduce a acumuladores por marca de tiempo, sin
+    conservar las filas. progress(bytes_leidos, filas_leidas) se llama tras
+    cada bloque. Devuelve {'partials': {kind: DataFrame}, 'rows', 'valid_rows'}.
+    """
+    parts = {}
+    rows = valid_rows = 0
+    date_col = value_cols = date_format = None
+    with open(path, 'rb') as f:
+        for chunk in pd.read_csv(f, chunksize=chunksize):
+            if date_col is None:
+                date_col, value_cols = resolve_upload_columns(chunk.columns)
+                if not date_col or not value_cols:
+                    raise ValueError(f'Se requieren columnas: date y al menos una de '
+                                     f'{", ".join(POLLUTANTS)} (o equivalentes)')
+                # El formato de fecha se decide una vez con el primer bloque
+                date_format = _detect_date_format(chunk[date_col].head(SNIFF_ROWS))
+            dates = _parse_dates(chunk[date_col], date_format)
+            any_value = pd.Series(False, index=chunk.index)
+            for kind, col in value_cols.items():
+                values = pd.to_numeric(chunk[col], errors='coerce')
+                valid = dates.notna() & values.notna()
+                any_value |= valid
+                parts.setdefault(kind, []).append(
+                    _group_partials(values[valid], [dates[valid].rename('date')], _empty_partials))
+            rows += len(chunk)
+            valid_rows += int(any_value.sum())
+            if progress is not None:
+                progress(f.tell(), rows)
+    if date_col is None:
+        raise ValueError('El archivo no tiene filas')
+    partials = {kind: _combine_partials(frames) for kind, frames in parts.items()}
+    return {'partials': {kind: p for kind, p in partials.items() if not p.empty},
+            'rows': rows, 'valid_rows': valid_rows}
+
+
+def partials_summary(partials: dict) -> dict:
+    """Conteo, rango de fechas, mínimo, máximo y promedio de cada contaminante"""
+    summary = {}
+    for kind, p in partials.items():
+        count = int(p['count'].sum())
+        summary[kind] = {
+            'count': count,
+            'start': p.index.min().isoformat() if count else None,
+            'end': p.index.max().isoformat() if count else None,
+            'min': float(p['min'].min()) if count else None,
+            'max': float(p['max'].max()) if count else None,
+            'mean': float(p['sum'].sum() / count) if count else None,
+        }
+    return summary
+
+
+def _load_partials_job(path: str, kind: str, spec: dict, chunksize: Optional[int]) -> dict:
+    """Tarea de un proceso del pool: procesa un contaminante"""
+    # Los procesos nuevos solo conocen el registro por defecto
+    POLLUTANTS.setdefault(kind, spec)
+    return load_partials(path, kind, chunksize)
+
+
+def load_local_partials(directory: str = '.', chunksize: Optional[int] = CHUNK_SIZE,
+                        workers: Optional[int] = None) -> Optional[dict]:
+    """
+    Acumuladores de cada contaminante registrado a partir de los CSV locales
+    (None si no hay ninguno). Los fragmentos que no están al día en la caché
+    se procesan en paralelo, uno por proceso, y los de un mismo contaminante
+    se combinan sumando sus acumuladores.
+    """
+    files = _scan_for_files(directory)
+    if not files:
+        return None
+    parts = {kind: [] for kind in files}
+    stale = []
+    for kind, paths in files.items():
+        for path in paths:
+            cached = _read_cached_partials(path, kind)
+            if _is_fresh(cached, _file_fingerprint(path)):
+                parts[kind].append({'hourly': cached['hourly'], 'cells': cached['cells']})
+            else:
+                stale.append((kind, path))
+
+    workers = min(len(stale), workers or os.cpu_count() or 1)
+    if workers > 1:
+        # spawn evita heredar locks de los hilos del servidor al hacer fork
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [(kind, path, pool.submit(_load_partials_job, path, kind, POLLUTANTS[kind], chunksize))
+                       for kind, path in stale]
+            for kind, path, future in futures:
+                try:
+                    parts[kind].append(future.result())
+                except Exception as e:
+                    logging.error(f"Error al cargar {path} ({kind}): {e}")
+    else:
+        for kind, path in stale:
+            try:
+                parts[kind].append(load_partials(path, kind, chunksize))
+            except Exception as e:
+                logging.error(f"Error al cargar {path} ({kind}): {e}")
+
+    # Un fragmento que falla se omite y los demás del mismo contaminante se sirven
+    partials = {kind: _combine_file_partials(p) for kind, p in parts.items() if p}
+    return partials or None
+
+
+def value_columns(arrays: dict) -> List[str]:
+    """Columnas de promedio (una por contaminante) presentes en los arreglos"""
+    return [c for c in arrays if c != 'date' and not c.endswith(STAT_SUFFIXES)]
+
+
+def _json_values(values: np.ndarray) -> list:
+    """tolist() que convierte NaN en None (null en JSON)"""
+    if values.dtype.kind == 'f':
+        missing = np.isnan(values)
+        if missing.any():
+            values = values.astype(object)
+            values[missing] = None
+    return values.tolist()
+
+
+def format_dates(dates: np.ndarray, date_unit: str = 'D') -> List[str]:
+    """Serializa las fechas de forma vectorizada directamente desde el arreglo NumPy"""
+    return np.datetime_as_string(dates, unit=date_unit).tolist()
+
+
+def arrays_to_records(arrays: dict, columns: Optional[List[str]] = None, date_unit: str = 'D') -> List[dict]:
+    """Convierte arreglos en la lista de puntos que consume la gráfica"""
+    columns = columns or value_columns(arrays)
+    keys = ['date'] + list(columns)
+    dates = format_dates(arrays['date'], date_unit)
+    values = [_json_values(arrays[c]) for c in columns]
+    return [dict(zip(keys, row)) for row in zip(dates, *values)]
+
+
+def arrays_to_columnar(arrays: dict, columns: Optional[List[str]] = None, date_unit: str = 'D',
+                       encoding: Optional[str] = None) -> dict:
+    """
+    Formato columnar {'date': [...], 'no2': [...], 'hch': [...], ...}. Con
+    encoding='float32' cada columna de valores se envía como base64 de un
+    Float32Array little-endian (NaN donde falta el dato), listo para leerse
+    en el navegador.
+    """
+    columns = columns or value_columns(arrays)
+    result = {'date': format_dates(arrays['date'], date_unit)}
+    for c in columns:
+        if encoding == 'float32':
+            result[c] = base64.b64encode(arrays[c].astype('<f4').tobytes()).decode('ascii')
+        else:
+            result[c] = _json_values(arrays[c])
+    return result
+
+
+def slice_range(dates: np.ndarray, start=None, end=None) -> (int, int):
+    """
+    Devuelve los límites [i, j) de las fechas dentro de [start, end] mediante
+    búsqueda binaria sobre el arreglo ordenado.
+    """
+    i = 0 if start is None else int(np.searchsorted(dates, np.datetime64(pd.Timestamp(start), 'ns'), side='left'))
+    j = len(dates) if end is None else int(np.searchsorted(dates, np.datetime64(pd.Timestamp(end), 'ns'), side='right'))
+    return i, max(i, j)
+
+
+def lttb_indices(x: np.ndarray, ys: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets sobre varias series que comparten el eje x.
+    Cada serie se escala por su rango para que todas pesen igual en el área
+    del triángulo. Los huecos (NaN) no entran en el promedio del bucket y
+    aportan área cero, así que no atraen la selección. Devuelve los índices
+    de los puntos conservados.
+    """
+    n = len(x)
+    if threshold >= n:
+        return np.arange(n)
+    if threshold < 3:
+        return np.array([0, n - 1][:max(threshold, 1)], dtype=np.int64)
+    x = x.astype('float64')
+    ys = ys.astype('float64').reshape(n, -1)
+    missing = np.isnan(ys)
+    spread = np.where(missing, -np.inf, ys).max(axis=0) - np.where(missing, np.inf, ys).min(axis=0)
+    ys = ys / np.where(np.isfinite(spread) & (spread > 0), spread, 1.0)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    a = 0
+    for b in range(threshold - 2):
+        lo, hi = edges[b], edges[b + 1]
+        # Promedio del siguiente bucket (o el último punto) como tercer vértice
+        nlo, nhi = hi, edges[b + 2] if b + 2 < len(edges) else n
+        cx = x[nlo:nhi].mean()
+        present = (~missing[nlo:nhi]).sum(axis=0)
+        cy = np.divide(np.nansum(ys[nlo:nhi], axis=0), present,
+                       out=np.full(ys.shape[1], np.nan), where=present > 0)
+        area = np.abs((x[a] - cx) * (ys[lo:hi] - ys[a]) - (x[a] - x[lo:hi, None]) * (cy - ys[a]))
+        area = np.nan_to_num(area, nan=0.0).sum(axis=1)
+        a = lo + int(np.argmax(area))
+        selected[b + 1] = a
+    return selected
+
+
+def query_series(arrays: dict, start=None, end=None, max_points: Optional[int] = None) -> dict:
+    """Recorta la serie al rango pedido y la reduce a max_points con LTTB"""
+    i, j = slice_range(arrays['date'], start, end)
+    result = {k: v[i:j] for k, v in arrays.items()}
+    if max_points and len(result['date']) > max_points:
+        idx = lttb_indices(result['date'].view('int64'),
+                           np.column_stack([result[k] for k in value_columns(result)]),
+                           max_points)
+        result = {k: v[idx] for k, v in result.items()}
+    return result
+
+
+def _write_mapped_snapshot(directory: str, version: str, levels: dict, cells: dict,
+                           reuse_from: Optional[str] = None, reuse=(), started: Optional[float] = None) -> str:
+    """
+    Guarda cada columna de los niveles y del índice por celda como un .npy de
+    ancho fijo en <directory>/<version>/ y devuelve esa ruta. Se escribe en
+    una carpeta temporal que se renombra al final, así otro proceso nunca ve
+    una versión a medias. Los grupos de reuse (p. ej. 'levels/hour') no
+    cambiaron respecto a la versión reuse_from y se enlazan desde ella.
+    Se borran solo las versiones publicadas antes de started (cuando empezó
+    a construirse esta): una más nueva de otro proceso se conserva. También
+    las carpetas temporales anteriores a started y sin cambios desde hace
+    STALE_BUILD_AGE segundos, que dejan las construcciones interrumpidas.
+    """
+    target = os.path.join(directory, version)
+    if os.path.isdir(target):
+        return target
+    os.makedirs(directory, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=f'.{version}.', dir=directory)
+    manifest = {}
+    groups = [(f'levels/{level}', arrays) for level, arrays in levels.items()]
+    groups += [(f'cells/{kind}', index) for kind, index in cells.items()]
+    for group, arrays in groups:
+        os.makedirs(os.path.join(tmp, group))
+        manifest[group] = list(arrays)
+        for column, values in arrays.items():
+            path = os.path.join(tmp, group, f'{column}.npy')
+            try:
+                if group not in reuse:
+                    raise OSError
+                os.link(os.path.join(directory, reuse_from, group, f'{column}.npy'), path)
+            except OSError:
+                np.save(path, np.ascontiguousarray(values))
+    with open(os.path.join(tmp, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        # Otro proceso publicó la misma versión primero
+        shutil.rmtree(tmp, ignore_errors=True)
+    # Las versiones anteriores siguen legibles para quien ya las tenga mapeadas
+    started = time.time() if started is None else started
+    # Una carpeta temporal reciente puede ser de otra construcción en curso
+    stale_tmp = min(started, time.time() - STALE_BUILD_AGE)
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name == version:
+            continue
+        try:
+            if os.stat(path).st_mtime < (stale_tmp if name.startswith('.') else started):
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+    return target
+
+
+def _load_mapped_snapshot(directory: str, version: str) -> Optional[dict]:
+    """
+    Abre una versión publicada con np.load(mmap_mode='r'): los arreglos son
+    vistas de solo lectura sobre el mismo archivo, compartidas entre procesos
+    a través de la caché de páginas del sistema (None si no existe).
+    """
+    target = os.path.join(directory, version)
+    try:
+        with open(os.path.join(target, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        mapped = {'levels': {}, 'cells': {}}
+        for group, columns in manifest.items():
+            section, name = group.split('/', 1)
+            mapped[section][name] = {c: np.load(os.path.join(target, group, f'{c}.npy'), mmap_mode='r')
+                                     for c in columns}
+        return mapped
+    except (OSError, ValueError):
+        return None
+
+
+class TimeseriesManager:
+    """
+    Caché de la serie combinada invalidada por la huella (ruta, tamaño, mtime)
+    de los CSV de origen. Sirve la última versión de inmediato y, si los
+    archivos cambian, la reconstruye en segundo plano (stale-while-revalidate).
+    Con un store (TimeseriesStore) compartido, solo el primer proceso que ve
+    una versión nueva lee los CSV; los demás la toman del almacén. Con
+    mmap_dir, los arreglos del snapshot se publican en disco y se mapean en
+    memoria, de modo que todos los procesos comparten una sola copia.
+    """
+
+    def __init__(self, directory='.', chunksize=CHUNK_SIZE, workers=None, store=None, mmap_dir=None):
+        """Inicializa la caché sin datos; se construye en la primera consulta"""
+        self.directory = directory
+        self.chunksize = chunksize
+        self.workers = workers
+        self.store = store
+        self.mmap_dir = mmap_dir
+        # Cada snapshot es inmutable: se reemplaza completo, nunca se modifica
+        self._snapshot = {'fingerprint': None, 'version': '',
+                          'levels': {level: _empty_arrays(list(POLLUTANTS)) for level in ROLLUP_LEVELS},
+                          'cells': {}}
+        self._build_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._refresh_thread = None
+        # Acumuladores diarios locales de la última versión de los CSV, para
+        # aplicar correcciones nuevas sin volver a leer la serie completa
+        self._local_daily = None
+        self._local_daily_version = None
+        # Momento en que empezó la reconstrucción en curso (ver _write_mapped_snapshot)
+        self._build_started = None
+
+    def fingerprint(self):
+        """
+        Calcula la huella actual: archivos de origen y versión de las
+        correcciones subidas (None si no hay ni unos ni otras)
+        """
+        try:
+            paths = _scan_for_files(self.directory)
+            files = tuple((kind, tuple(_file_fingerprint(p) for p in shards))
+                          for kind, shards in sorted(paths.items())) or None
+        except OSError:
+            files = None
+        overrides = self.store.overrides_version() if self.store is not None else ''
+        if files is None and not overrides:
+            return None
+        return files, overrides
+
+    def get(self):
+        """
+        Devuelve el snapshot vigente. La primera carga es síncrona; las
+        siguientes devuelven el snapshot anterior mientras se reconstruye.
+        """
+        current = self.fingerprint()
+        snapshot = self._snapshot
+        if current is None or snapshot['fingerprint'] == current:
+            return snapshot
+        if snapshot['fingerprint'] is None:
+            return self.refresh()
+        self._start_background_refresh()
+        return snapshot
+
+    def get_data(self) -> List[dict]:
+        """Atajo para obtener la serie completa como lista de puntos"""
+        return arrays_to_records(self.get()['levels']['day'])
+
+    def query(self, start=None, end=None, max_points: Optional[int] = None, agg: str = 'day') -> dict:
+        """
+        Devuelve los arreglos del nivel de agregación pedido, recortados al
+        rango y reducidos a max_points si se indica
+        """
+        if agg not in ROLLUP_LEVELS:
+            raise ValueError(f'Nivel de agregación desconocido: {agg}')
+        return query_series(self.get()['levels'][agg], start, end, max_points)
+
+    def query_region(self, bbox: tuple, start=None, end=None, max_points: Optional[int] = None,
+                     agg: str = 'day', snapshot: Optional[dict] = None) -> dict:
+        """
+        Igual que query pero limitado a la caja (min_lon, min_lat, max_lon,
+        max_lat), respondida desde los agregados diarios por celda. El nivel
+        más fino disponible por región es el día.
+        """
+        if agg not in ROLLUP_LEVELS or agg == 'hour':
+            raise ValueError(f'Nivel de agregación no disponible por región: {agg}')
+        snapshot = snapshot or self.get()
+        if not snapshot['cells']:
+            return _empty_arrays(list(POLLUTANTS))
+        partials = {kind: region_partials(index, bbox) for kind, index in snapshot['cells'].items()}
+        return query_series(_merge_kinds(partials, agg), start, end, max_points)
+
+    def refresh(self):
+        """Reconstruye la serie y publica el nuevo snapshot de forma atómica"""
+        with self._build_lock:
+            current = self.fingerprint()
+            snapshot = self._snapshot
+            if current is None or snapshot['fingerprint'] == current:
+                return snapshot
+            # Si los archivos cambian durante la lectura, la huella guardada
+            # queda desfasada y la próxima consulta vuelve a reconstruir
+            version = _snapshot_version(current)
+            self._build_started = time.time()
+            mapped = _load_mapped_snapshot(self.mmap_dir, version) if self.mmap_dir else None
+            if mapped is not None:
+                levels, cells = mapped['levels'], mapped['cells']
+            elif current[0] is not None and snapshot['fingerprint'] is not None and snapshot['fingerprint'][0] == current[0]:
+                # Solo cambiaron las correcciones subidas
+                levels, cells = self._apply_overrides(snapshot, current[0], version)
+            else:
+                levels, cells = self._build_arrays(current[0], version)
+            snapshot = {'fingerprint': current, 'version': version,
+                        'levels': levels, 'cells': cells}
+            self._snapshot = snapshot
+            return snapshot
+
+    def _build_arrays(self, files, version: str) -> (dict, dict):
+        """Niveles e índice por celda de la versión; mapeados desde disco si hay mmap_dir"""
+        partials = self._load_partials(_snapshot_version(files)) if files else None
+        # Las correcciones subidas se guardan aparte y nunca las pisa la ingestión local
+        overrides = self.store.read_overrides() if self.store is not None else {}
+        if partials is None and not overrides:
+            return {level: _empty_arrays(list(POLLUTANTS)) for level in ROLLUP_LEVELS}, {}
+        partials = partials or {}
+        local_daily = {kind: rollup_partials(p['hourly'], 'day') for kind, p in partials.items()}
+        if files:
+            self._local_daily, self._local_daily_version = local_daily, _snapshot_version(files)
+        levels = {'hour': _merge_kinds({kind: p['hourly'] for kind, p in partials.items()}, 'hour')}
+        levels.update(daily_levels(local_daily, overrides))
+        cells = {kind: build_cell_index(p['cells']) for kind, p in partials.items()}
+        return self._publish(version, levels, cells)
+
+    def _apply_overrides(self, snapshot: dict, files, version: str) -> (dict, dict):
+        """
+        Nueva versión cuando solo cambiaron las correcciones: la hora y el
+        índice por celda no las usan y se conservan del snapshot anterior;
+        día, semana y mes se recalculan desde los acumuladores diarios locales
+        (en memoria, o solo los horarios desde el almacén, sin las celdas).
+        """
+        files_version = _snapshot_version(files)
+        if self._local_daily_version != files_version:
+            if self.store.version('local') != files_version:
+                return self._build_arrays(files, version)
+            hourly = self.store.read_partials('local')
+            self._local_daily = {kind: rollup_partials(p, 'day') for kind, p in hourly.items()}
+            self._local_daily_version = files_version
+        levels = {'hour': snapshot['levels']['hour']}
+        levels.update(daily_levels(self._local_daily, self.store.read_overrides()))
+        reuse = ['levels/hour'] + [f'cells/{kind}' for kind in snapshot['cells']]
+        return self._publish(version, levels, snapshot['cells'], snapshot['version'], reuse)
+
+    def _publish(self, version: str, levels: dict, cells: dict,
+                 reuse_from: Optional[str] = None, reuse=()) -> (dict, dict):
+        """Publica los arreglos en mmap_dir (si hay) y los devuelve mapeados"""
+        if self.mmap_dir:
+            try:
+                _write_mapped_snapshot(self.mmap_dir, version, levels, cells, reuse_from, reuse,
+                                       self._build_started)
+                mapped = _load_mapped_snapshot(self.mmap_dir, version)
+                if mapped is not None:
+                    return mapped['levels'], mapped['cells']
+            except OSError as e:
+                logging.error(f"No se pudo publicar la serie en {self.mmap_dir}: {e}")
+        return levels, cells
+
+    def _load_partials(self, version: str) -> Optional[dict]:
+        """
+        Acumuladores de la versión pedida, desde el almacén compartido si ya la
+        tiene. Si no, un solo proceso lee los CSV (reclamo en el almacén) y
+        los demás esperan a que la guarde en lugar de leerlos también.
+        """
+        if self.store is None:
+            return load_local_partials(self.directory, self.chunksize, self.workers)
+        owner = uuid.uuid4().hex
+        while True:
+            state = self.store.claim_ingest(version, owner)
+            if state == INGEST_DONE:
+                return self.store.read_local()
+            if state == INGEST_CLAIMED:
+                break
+            time.sleep(INGEST_POLL_INTERVAL)
+        try:
+            partials = load_local_partials(self.directory, self.chunksize, self.workers)
+            if partials is not None:
+                self.store.write_local(partials, version)
+            return partials
+        finally:
+            self.store.release_ingest(owner)
+
+    def _start_background_refresh(self):
+        """Lanza una única reconstrucción en segundo plano si no hay otra en curso"""
+        with self._thread_lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self._background_refresh, daemon=True)
+            self._refresh_thread.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logging.error(f"Error al reconstruir la serie temporal: {e}")
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Almacén persistente (SQLite) de la serie temporal compartido por todos los
+procesos del servidor web. Guarda los acumuladores horarios por contaminante
+y los diarios por celda de la rejilla, indexados por (origen, contaminante,
+fecha), de modo que cada proceso lee por rangos en lugar de volver a leer
+los CSV. Las subidas manuales se guardan como correcciones diarias que se
+combinan con la serie local en todos los procesos.
+"""
+
+import sqlite3
+import json
+import time
+from typing import Optional, List
+
+import numpy as np
+import pandas as pd
+
+from timeseries_manager import (PARTIAL_AGG, OVERRIDE_MODES, INGEST_DONE, INGEST_CLAIMED, INGEST_BUSY,
+                                _empty_cell_partials, rollup_partials)
+
+# Orígenes de datos: CSV locales y correcciones subidas manualmente
+LOCAL_SOURCE = 'local'
+UPLOAD_SOURCE = 'upload'
+
+PARTIAL_COLUMNS = list(PARTIAL_AGG)
+COLUMN_TYPES = {'pollutant': 'TEXT', 'cell': 'INTEGER', 'date': 'INTEGER',
+                'sum': 'REAL', 'count': 'INTEGER', 'min': 'REAL', 'max': 'REAL'}
+
+# Segundos tras los que un reclamo de ingestión se da por abandonado (el
+# proceso que lo tomó murió o se colgó) y otro proceso puede tomarlo
+INGEST_CLAIM_TTL = 300
+
+
+def _to_ns(value) -> Optional[int]:
+    """Marca de tiempo (texto o Timestamp) en nanosegundos desde la época"""
+    if value is None:
+        return None
+    return int(pd.Timestamp(value).value)
+
+
+class TimeseriesStore:
+    def __init__(self, db_name="timeseries.db"):
+        """Inicializa la conexión a la base de datos"""
+        self.db_name = db_name
+        self.init_database()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=30)
+        # WAL permite leer mientras otro proceso escribe una versión nueva
+        conn.execute('PRAGMA journal_mode=WAL')
+        # Las tablas temporales de write_local no pasan por disco
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def init_database(self):
+        """Crea las tablas de acumuladores si no existen"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS series_partials (
+                source TEXT NOT NULL,
+                pollutant TEXT NOT NULL,
+                date INTEGER NOT NULL,
+                sum REAL NOT NULL,
+                count INTEGER NOT NULL,
+                min REAL NOT NULL,
+                max REAL NOT NULL,
+                PRIMARY KEY (source, pollutant, date)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cell_partials (
+                pollutant TEXT NOT NULL,
+                cell INTEGER NOT NULL,
+                date INTEGER NOT NULL,
+                sum REAL NOT NULL,
+                count INTEGER NOT NULL,
+                min REAL NOT NULL,
+                max REAL NOT NULL,
+                PRIMARY KEY (pollutant, cell, date)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS series_overrides (
+                pollutant TEXT NOT NULL,
+                date INTEGER NOT NULL,
+                sum REAL NOT NULL,
+                count INTEGER NOT NULL,
+                min REAL NOT NULL,
+                max REAL NOT NULL,
+                mode TEXT NOT NULL,
+                PRIMARY KEY (pollutant, date)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS store_versions (
+                source TEXT PRIMARY KEY,
+                version TEXT NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ingest_claims (
+                source TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                version TEXT NOT NULL,
+                claimed_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS upload_jobs (
+                id TEXT PRIMARY KEY,
+                filename TEXT,
+                status TEXT NOT NULL,
+                bytes_total INTEGER NOT NULL DEFAULT 0,
+                bytes_read INTEGER NOT NULL DEFAULT 0,
+                rows_read INTEGER NOT NULL DEFAULT 0,
+                rows_valid INTEGER NOT NULL DEFAULT 0,
+                summary TEXT,
+                error TEXT,
+                fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                fecha_fin TIMESTAMP
+            )
+        ''')
+
+        conn.commit()
+        conn.close()
+
+    def version(self, source: str) -> str:
+        """Versión guardada para el origen ('' si nunca se escribió)"""
+        conn = self._connect()
+        row = conn.execute("SELECT version FROM store_versions WHERE source = ?", (source,)).fetchone()
+        conn.close()
+        return row[0] if row else ''
+
+    def claim_ingest(self, version: str, owner: str, ttl: float = INGEST_CLAIM_TTL) -> str:
+        """
+        Reclama la lectura de los CSV locales para la versión pedida, de modo
+        que un solo proceso la haga. Devuelve INGEST_DONE si la versión ya está
+        guardada, INGEST_CLAIMED si owner debe leerla (y luego llamar a
+        release_ingest) o INGEST_BUSY si otro proceso está leyendo.
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            row = cursor.execute("SELECT version FROM store_versions WHERE source = ?",
+                                 (LOCAL_SOURCE,)).fetchone()
+            if row and row[0] == version:
+                conn.rollback()
+                return INGEST_DONE
+            claim = cursor.execute("SELECT owner, claimed_at FROM ingest_claims WHERE source = ?",
+                                   (LOCAL_SOURCE,)).fetchone()
+            now = time.time()
+            if claim and claim[0] != owner and now - claim[1] < ttl:
+                conn.rollback()
+                return INGEST_BUSY
+            cursor.execute("INSERT OR REPLACE INTO ingest_claims (source, owner, version, claimed_at) VALUES (?, ?, ?, ?)",
+                           (LOCAL_SOURCE, owner, version, now))
+            conn.commit()
+            return INGEST_CLAIMED
+        finally:
+            conn.close()
+
+    def release_ingest(self, owner: str):
+        """Libera el reclamo de owner (si sigue siendo suyo)"""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM ingest_claims WHERE source = ? AND owner = ?", (LOCAL_SOURCE, owner))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _sync_rows(self, cursor, table: str, key: List[str], rows, fixed: Optional[dict] = None):
+        """
+        Deja en table (limitada a las columnas fijas de fixed, p. ej. el
+        origen) exactamente las filas dadas, con clave key y columnas sum,
+        count, min y max. Las filas se cargan en una tabla temporal en memoria
+        y solo se escriben en la base las nuevas, las que cambiaron y las que
+        desaparecieron: una versión que solo añadió horas no reescribe el
+        historial completo.
+        """
+        fixed = fixed or {}
+        columns = key + PARTIAL_COLUMNS
+        staging = f"temp.new_{table}"
+        cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+        # Con los mismos tipos que la tabla destino, para que la comparación
+        # de claves use los índices
+        definitions = ', '.join(f"{c} {COLUMN_TYPES[c]}" for c in columns)
+        cursor.execute(f"CREATE TEMP TABLE new_{table} ({definitions}, "
+                       f"PRIMARY KEY ({', '.join(key)})) WITHOUT ROWID")
+        cursor.executemany(f"INSERT INTO {staging} VALUES ({', '.join('?' * len(columns))})", rows)
+        cursor.execute(f'''
+            INSERT INTO {table} ({', '.join([*fixed, *columns])})
+            SELECT {', '.join(['?'] * len(fixed) + columns)} FROM {staging} WHERE true
+            ON CONFLICT ({', '.join([*fixed, *key])}) DO UPDATE SET
+                {', '.join(f"{c} = excluded.{c}" for c in PARTIAL_COLUMNS)}
+            WHERE {' OR '.join(f"{c} IS NOT excluded.{c}" for c in PARTIAL_COLUMNS)}
+        ''', tuple(fixed.values()))
+        scope = ''.join(f" AND {c} = ?" for c in fixed)
+        matches = ' AND '.join(f"n.{c} = {table}.{c}" for c in key)
+        cursor.execute(f'''
+            DELETE FROM {table} WHERE NOT EXISTS (SELECT 1 FROM {staging} n WHERE {matches}){scope}
+        ''', tuple(fixed.values()))
+        cursor.execute(f"DROP TABLE {staging}")
+
+    @staticmethod
+    def _hourly_rows(partials: dict):
+        for kind, p in partials.items():
+            hourly = p['hourly']
+            dates = hourly.index.to_numpy(dtype='datetime64[ns]').view('int64')
+            yield from zip([kind] * len(dates), dates.tolist(), *(hourly[c].tolist() for c in PARTIAL_COLUMNS))
+
+    @staticmethod
+    def _cell_rows(partials: dict):
+        for kind, p in partials.items():
+            cells = p['cells']
+            yield from zip([kind] * len(cells),
+                           cells.index.get_level_values('cell').to_numpy(dtype='int64').tolist(),
+                           cells.index.get_level_values('date').to_numpy(dtype='datetime64[ns]').view('int64').tolist(),
+                           *(cells[c].tolist() for c in PARTIAL_COLUMNS))
+
+    def write_local(self, partials: dict, version: str) -> bool:
+        """
+        Reemplaza los acumuladores de los CSV locales ({kind: {'hourly', 'cells'}})
+        en una sola transacción, escribiendo solo las filas que cambiaron.
+        Devuelve False si otro proceso ya guardó esa versión.
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            # BEGIN IMMEDIATE serializa a los escritores antes de comparar la versión
+            cursor.execute('BEGIN IMMEDIATE')
+            row = cursor.execute("SELECT version FROM store_versions WHERE source = ?",
+                                 (LOCAL_SOURCE,)).fetchone()
+            if row and row[0] == version:
+                conn.rollback()
+                return False
+            self._sync_rows(cursor, 'series_partials', ['pollutant', 'date'],
+                            self._hourly_rows(partials), {'source': LOCAL_SOURCE})
+            self._sync_rows(cursor, 'cell_partials', ['pollutant', 'cell', 'date'], self._cell_rows(partials))
+            cursor.execute("INSERT OR REPLACE INTO store_versions (source, version) VALUES (?, ?)",
+                           (LOCAL_SOURCE, version))
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def write_upload(self, arrays: dict, mode: str = 'replace') -> str:
+        """
+        Combina una serie subida manualmente (arreglos date + un arreglo por
+        contaminante; NaN = sin dato) con las correcciones guardadas
+        """
+        return self.upsert_overrides(self._arrays_to_partials(arrays), mode)
+
+    @staticmethod
+    def _arrays_to_partials(arrays: dict) -> dict:
+        partials = {}
+        for kind in arrays:
+            if kind == 'date':
+                continue
+            values = arrays[kind]
+            keep = ~np.isnan(values)
+            frame = pd.DataFrame({'sum': values[keep], 'count': np.ones(keep.sum(), dtype='int64'),
+                                  'min': values[keep], 'max': values[keep]},
+                                 index=pd.DatetimeIndex(arrays['date'][keep], name='date'))
+            partials[kind] = frame.groupby(level=0).agg(PARTIAL_AGG)
+        return partials
+
+    def upsert_overrides(self, partials: dict, mode: str = 'replace') -> str:
+        """
+        Inserta o actualiza correcciones diarias a partir de acumuladores
+        {kind: DataFrame} y devuelve la nueva versión de las correcciones.
+        Cada día se localiza por la clave primaria (O(log n) por fila); si ya
+        había una corrección, 'replace' la sustituye y 'average' suma sus
+        acumuladores. El modo queda guardado para combinarla con la serie local.
+        """
+        if mode not in OVERRIDE_MODES:
+            raise ValueError(f'mode debe ser uno de {", ".join(OVERRIDE_MODES)}')
+        if mode == 'replace':
+            on_conflict = ('sum = excluded.sum, count = excluded.count, min = excluded.min, '
+                           'max = excluded.max, mode = excluded.mode')
+        else:
+            on_conflict = ('sum = sum + excluded.sum, count = count + excluded.count, '
+                           'min = MIN(min, excluded.min), max = MAX(max, excluded.max)')
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            for kind, p in partials.items():
+                daily = rollup_partials(p, 'day')
+                dates = daily.index.to_numpy(dtype='datetime64[ns]').view('int64')
+                rows = zip([kind] * len(dates), dates.tolist(),
+                           *(daily[c].tolist() for c in PARTIAL_COLUMNS), [mode] * len(dates))
+                cursor.executemany(f'''
+                    INSERT INTO series_overrides (pollutant, date, sum, count, min, max, mode)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (pollutant, date) DO UPDATE SET {on_conflict}
+                ''', rows)
+            row = cursor.execute("SELECT version FROM store_versions WHERE source = ?",
+                                 (UPLOAD_SOURCE,)).fetchone()
+            version = str(int(row[0]) + 1 if row else 1)
+            cursor.execute("INSERT OR REPLACE INTO store_versions (source, version) VALUES (?, ?)",
+                           (UPLOAD_SOURCE, version))
+            conn.commit()
+            return version
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def overrides_version(self) -> str:
+        """Versión de las correcciones subidas ('' si no hay ninguna)"""
+        return self.version(UPLOAD_SOURCE)
+
+    def read_overrides(self, start=None, end=None) -> dict:
+        """Correcciones diarias {kind: DataFrame con sum, count, min, max y mode}"""
+        query = "SELECT pollutant, date, sum, count, min, max, mode FROM series_overrides WHERE 1 = 1"
+        params = []
+        if start is not None:
+            query += " AND date >= ?"
+            params.append(_to_ns(start))
+        if end is not None:
+            query += " AND date <= ?"
+            params.append(_to_ns(end))
+        conn = self._connect()
+        df = pd.read_sql_query(query + " ORDER BY pollutant, date", conn, params=params)
+        conn.close()
+        overrides = {}
+        for kind, group in df.groupby('pollutant', sort=False):
+            frame = group[PARTIAL_COLUMNS + ['mode']].set_index(
+                pd.DatetimeIndex(group['date'].to_numpy(dtype='datetime64[ns]'), name='date'))
+            overrides[kind] = frame.astype({'count': 'int64'})
+        return overrides
+
+    def read_partials(self, source: str, start=None, end=None) -> dict:
+        """
+        Acumuladores {kind: DataFrame} del origen, leídos por rango de fecha
+        sobre la clave primaria; como slice_range, [start, end] es inclusivo
+        """
+        query = "SELECT pollutant, date, sum, count, min, max FROM series_partials WHERE source = ?"
+        params = [source]
+        if start is not None:
+            query += " AND date >= ?"
+            params.append(_to_ns(start))
+        if end is not None:
+            query += " AND date <= ?"
+            params.append(_to_ns(end))
+        conn = self._connect()
+        df = pd.read_sql_query(query + " ORDER BY pollutant, date", conn, params=params)
+        conn.close()
+        partials = {}
+        for kind, group in df.groupby('pollutant', sort=False):
+            frame = group[PARTIAL_COLUMNS].set_index(pd.DatetimeIndex(group['date'].to_numpy(dtype='datetime64[ns]'), name='date'))
+            partials[kind] = frame.astype({'count': 'int64'})
+        return partials
+
+    def read_cells(self) -> dict:
+        """Acumuladores diarios por celda {kind: DataFrame indexado por (cell, date)}"""
+        conn = self._connect()
+        df = pd.read_sql_query("SELECT pollutant, cell, date, sum, count, min, max FROM cell_partials "
+                               "ORDER BY pollutant, cell, date", conn)
+        conn.close()
+        cells = {}
+        for kind, group in df.groupby('pollutant', sort=False):
+            index = pd.MultiIndex.from_arrays(
+                [group['cell'].to_numpy(dtype='int64'), group['date'].to_numpy(dtype='datetime64[ns]')],
+                names=['cell', 'date'])
+            cells[kind] = pd.DataFrame(group[PARTIAL_COLUMNS].to_numpy(), index=index,
+                                       columns=PARTIAL_COLUMNS).astype({'count': 'int64'})
+        return cells
+
+    def read_local(self) -> Optional[dict]:
+        """Acumuladores completos de los CSV locales en el formato de load_local_partials"""
+        hourly = self.read_partials(LOCAL_SOURCE)
+        if not hourly:
+            return None
+        cells = self.read_cells()
+        return {kind: {'hourly': p, 'cells': cells.get(kind, _empty_cell_partials())}
+                for kind, p in hourly.items()}
+
+    def create_job(self, job_id: str, filename: str, bytes_total: int):
+        """Registra un trabajo de subida pendiente"""
+        conn = self._connect()
+        conn.execute("INSERT INTO upload_jobs (id, filename, status, bytes_total) VALUES (?, ?, 'pending', ?)",
+                     (job_id, filename, bytes_total))
+        conn.commit()
+        conn.close()
+
+    def update_job(self, job_id: str, **fields):
+        """Actualiza el progreso o el resultado de un trabajo de subida"""
+        if 'summary' in fields:
+            fields['summary'] = json.dumps(fields['summary'])
+        if fields.get('status') in ('done', 'error'):
+            assignments = ', '.join(f"{k} = ?" for k in fields) + ", fecha_fin = CURRENT_TIMESTAMP"
+        else:
+            assignments = ', '.join(f"{k} = ?" for k in fields)
+        conn = self._connect()
+        conn.execute(f"UPDATE upload_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        conn.commit()
+        conn.close()
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        """Estado de un trabajo de subida (None si no existe)"""
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM upload_jobs WHERE id = ?", (job_id,)).fetchone()
+        conn.close()
+        if row is None:
+            return None
+        job = dict(row)
+        job['summary'] = json.loads(job['summary']) if job['summary'] else None
+        return job
@@ -4,129 +4,56 @@
 Servidor web Flask para manejar el formulario de registro
 """
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify
-from database_manager import DatabaseManager
+from flask import Flask, render_template, request, redirect, url_for, jsonify, Response, stream_with_context
+import json
+from database_manager import DatabaseManager, iter_user_records, decode_cursor, PAGE_SIZE
+from timeseries_manager import (TimeseriesManager, ROLLUP_LEVELS, LEVEL_DATE_UNITS, REGIONS, query_series,
+                                parse_bbox, arrays_to_records, arrays_to_columnar,
+                                load_upload_partials, partials_summary, OVERRIDE_MODES)
+from timeseries_store import TimeseriesStore
 import os
+import gzip
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 import pandas as pd
-from typing import Optional, List
+
+try:
+    import brotli  # Opcional: respuestas precomprimidas también en br
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.secret_key = 'tu_clave_secreta_aqui'  # Cambia esto en producción
 
-# Inicializar la base de datos
-db = DatabaseManager()
-
-# Almacén simple en memoria para la última serie temporal cargada
-timeseries_store = {'data': []}
-
-
-def _find_date_column(df: pd.DataFrame) -> Optional[str]:
-    candidates = ['date', 'fecha', 'dia', 'fecha_hora', 'timestamp', 'time']
-    lower_map = {c.lower().strip(): c for c in df.columns}
-    for k in candidates:
-        if k in lower_map:
-            return lower_map[k]
-    # fallback: try infer by dtype
-    for c in df.columns:
-        if pd.api.types.is_datetime64_any_dtype(df[c]):
-            return c
-    # fallback: detect textual date patterns like '23/08/02' or '2023-08-02'
-    sample = df.head(200)
-    for c in df.columns:
-        if pd.api.types.is_string_dtype(df[c]):
-            vals = sample[c].astype(str).str.strip().dropna()
-            if vals.str.contains(r"\b\d{2}/\d{2}/\d{2}\b").any() or vals.str.contains(r"\b\d{4}-\d{2}-\d{2}\b").any():
-                return c
-    return None
-
-
-def _find_value_column(df: pd.DataFrame, keywords: List[str]) -> Optional[str]:
-    lower_map = {c.lower().strip(): c for c in df.columns}
-    for k in keywords + ['value']:
-        for key in list(lower_map.keys()):
-            if k in key:
-                return lower_map[key]
-    # fallback: first numeric column excluding date
-    for c in df.columns:
-        if pd.api.types.is_numeric_dtype(df[c]):
-            return c
-    return None
-
-
-def _normalize_single(df: pd.DataFrame, kind: str) -> pd.DataFrame:
-    """
-    kind: 'no2' or 'hch'
-    Returns a dataframe with columns ['date', kind]
-    """
-    date_col = _find_date_column(df)
-    if date_col is None:
-        raise ValueError('No se encontró columna de fecha')
-    if kind == 'no2':
-        val_col = _find_value_column(df, ['no2'])
-    else:
-        val_col = _find_value_column(df, ['hch', 'hcho', 'formaldeh'])
-    if val_col is None:
-        raise ValueError(f'No se encontró columna de valor para {kind}')
-
-    out = df[[date_col, val_col]].copy()
-    # Try multiple date formats, including YY/MM/DD
-    out[date_col] = pd.to_datetime(out[date_col], errors='coerce', infer_datetime_format=True)
-    # If still NaT, attempt specific formats
-    mask_nat = out[date_col].isna()
-    if mask_nat.any():
-        try:
-            out.loc[mask_nat, date_col] = pd.to_datetime(out.loc[mask_nat, date_col].astype(str), format='%y/%m/%d', errors='coerce')
-        except Exception:
-            pass
-    out = out.dropna(subset=[date_col])
-    out[val_col] = pd.to_numeric(out[val_col], errors='coerce')
-    out = out.dropna(subset=[val_col])
-    out = out.rename(columns={date_col: 'date', val_col: kind})
-    out['date'] = out['date'].dt.normalize()
-    out = out.groupby('date', as_index=False)[kind].mean()
-    return out
-
-
-def _scan_for_files() -> (Optional[str], Optional[str]):
-    files = [f for f in os.listdir('.') if f.lower().endswith('.csv')]
-    no2_file = None
-    hch_file = None
-    for f in files:
-        name = f.lower()
-        if 'no2' in name and no2_file is None:
-            no2_file = f
-        if (('hch' in name) or ('hcho' in name) or ('formaldeh' in name)) and hch_file is None:
-            hch_file = f
-    return no2_file, hch_file
-
-
-def load_local_timeseries() -> List[dict]:
-    no2_path, hch_path = _scan_for_files()
-    if not no2_path or not hch_path:
-        return []
-    try:
-        no2_df_raw = pd.read_csv(no2_path)
-        hch_df_raw = pd.read_csv(hch_path)
-        no2_df = _normalize_single(no2_df_raw, 'no2')
-        hch_df = _normalize_single(hch_df_raw, 'hch')
-        merged = pd.merge(no2_df, hch_df, on='date', how='inner')
-        # Filter to requested range if present
-        try:
-            start = pd.Timestamp('2023-08-02')
-            end = pd.Timestamp('2025-09-01')
-            merged = merged[(merged['date'] >= start) & (merged['date'] <= end)]
-        except Exception:
-            pass
-        merged = merged.sort_values('date')
-        data = [{
-            'date': d.strftime('%Y-%m-%d'),
-            'no2': float(n),
-            'hch': float(h)
-        } for d, n, h in zip(merged['date'], merged['no2'], merged['hch'])]
-        return data
-    except Exception:
-        return []
+# Caché de la serie histórica construida a partir de los CSV locales; sus
+# arreglos se mapean desde SERIES_MMAP_DIR para que los procesos compartan memoria
+SERIES_MMAP_DIR = 'timeseries_mmap'
+
+# Los procesos del pool que lee los CSV (spawn) importan este módulo como
+# __mp_main__ cuando se ejecuta con python web_server.py; ahí no hacen falta
+# la base de datos, el almacén ni la caché de la serie
+if __name__ != '__mp_main__':
+    # Inicializar la base de datos
+    db = DatabaseManager()
+    
+    # Almacén SQLite compartido por todos los procesos del servidor: acumuladores
+    # de los CSV locales y la última serie subida manualmente
+    store = TimeseriesStore()
+    
+    series = TimeseriesManager(store=store, mmap_dir=SERIES_MMAP_DIR)
+
+# CSV subidos en espera de procesarse y tamaño de bloque al leerlos
+UPLOAD_SPOOL_DIR = 'uploads'
+UPLOAD_CHUNK_SIZE = 50_000
+
+# Cuerpos JSON ya serializados y comprimidos, indexados por ETag
+RESPONSE_CACHE_SIZE = 64
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
 
 @app.route('/')
 def index():
@@ -216,24 +143,82 @@ def register_institutional():
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error interno: {str(e)}'})
 
+def _user_to_dict(user):
+    return {
+        'id': user[0],
+        'email': user[1],
+        'created_at': user[2],
+        'last_access': user[3],
+        'active': bool(user[4])
+    }
+
 @app.route('/api/users')
 def api_users():
-    """API endpoint para obtener lista de usuarios (para el bot de Telegram)"""
+    """
+    API endpoint para obtener lista de usuarios (para el bot de Telegram),
+    del más reciente al más antiguo. Paginado por cursor: limit (máx. 1000)
+    y after=<next_cursor de la página anterior>. Con format=ndjson se
+    exporta el listado completo (desde after) como un usuario JSON por línea,
+    enviado a medida que se lee de la base de datos.
+    """
+    after = request.args.get('after') or None
     try:
-        users = db.list_users()
-        users_data = []
-        for user in users:
-            users_data.append({
-                'id': user[0],
-                'email': user[1],
-                'created_at': user[2],
-                'last_access': user[3],
-                'active': bool(user[4])
-            })
-        return jsonify({'success': True, 'users': users_data})
+        if after:
+            decode_cursor(after)
+        limit = int(request.args.get('limit', PAGE_SIZE))
+        if limit < 1:
+            raise ValueError('limit debe ser positivo')
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'Parámetros inválidos: {e}'}), 400
+    
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            for user in db.iter_users(after):
+                yield json.dumps(_user_to_dict(user), ensure_ascii=False) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    
+    try:
+        users, next_cursor = db.list_users_page(after, limit)
+        return jsonify({'success': True, 'users': [_user_to_dict(u) for u in users],
+                        'next_cursor': next_cursor})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/users/import', methods=['POST'])
+def api_import_users():
+    """
+    Registro masivo: recibe en el campo "file" un CSV (email,password) o un
+    NDJSON y devuelve el resultado de cada fila. El archivo se lee como flujo
+    y se inserta en lotes.
+    """
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'error': 'Envíe un archivo en el campo "file"'}), 400
+    f = request.files['file']
+    fmt = request.values.get('format')
+    if fmt is None:
+        fmt = 'ndjson' if (f.filename or '').lower().endswith(('.ndjson', '.jsonl')) else 'csv'
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'success': False, 'error': 'format debe ser csv o ndjson'}), 400
+    # Cada lote se confirma antes de aparecer en el reporte: si uno falla,
+    # las filas ya reportadas (las 'creado') quedaron registradas
+    report = []
+    error = None
+    try:
+        for row in db.bulk_register_users(iter_user_records(f.stream, fmt)):
+            report.append(row)
+    except Exception as e:
+        print(f"Error en el registro masivo tras {len(report)} filas: {e}")
+        error = str(e)
+    counts = {status: sum(1 for row in report if row['estado'] == status)
+              for status in ('creado', 'duplicado', 'invalido')}
+    result = {'success': error is None, 'created': counts['creado'], 'duplicates': counts['duplicado'],
+              'invalid': counts['invalido'], 'report': report}
+    if error is not None:
+        # Respuesta parcial: filas procesadas y registradas antes del error
+        result.update(error=error, processed=len(report), committed=counts['creado'])
+        return jsonify(result), 400
+    return jsonify(result)
+
 @app.route('/api/user/<email>')
 def api_user_info(email):
     """API endpoint para obtener información de un usuario específico"""
@@ -264,6 +249,11 @@ def api_check_user(email):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/user_cache')
+def api_user_cache():
+    """Contadores de la caché de consultas de usuarios (aciertos, fallos, invalidaciones)"""
+    return jsonify({'success': True, 'cache': db.cache_info()})
+
 @app.route('/api/login', methods=['POST'])
 def api_login():
     """API endpoint para login de usuarios (para el bot de Telegram)"""
@@ -298,60 +288,199 @@ def log_user_data(user_type, data):
         print(f"Error al escribir log: {e}")
 
 
+def _response_format():
+    """
+    Lee los parámetros format (rows/columnar) y encoding (float32, solo en
+    formato columnar) comunes a los endpoints de series temporales.
+    """
+    fmt = request.args.get('format', 'rows')
+    if fmt not in ('rows', 'columnar'):
+        raise ValueError('format debe ser rows o columnar')
+    encoding = request.args.get('encoding') or None
+    if encoding is not None and (encoding != 'float32' or fmt != 'columnar'):
+        raise ValueError('encoding=float32 solo está disponible con format=columnar')
+    return fmt, encoding
+
+
 @app.route('/api/upload_timeseries', methods=['POST'])
 def api_upload_timeseries():
     """
-    Sube un CSV con columnas: date, no2, hch (o equivalentes),
-    normaliza y almacena en memoria para graficar.
+    Recibe un CSV con una columna de fecha y al menos un contaminante
+    registrado (no2, hch, o3, ai o equivalentes) con correcciones diarias
+    que se combinan con la serie. mode=replace (por defecto) sustituye el
+    valor existente de cada día y mode=average lo promedia con él. El archivo
+    se guarda en disco y se procesa por bloques en segundo plano; se responde
+    de inmediato con el id del trabajo para consultar su avance.
     """
+    mode = request.values.get('mode', 'replace')
+    if mode not in OVERRIDE_MODES:
+        return jsonify({'success': False, 'error': f'mode debe ser uno de {", ".join(OVERRIDE_MODES)}'}), 400
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'error': 'Envíe un archivo en el campo "file"'}), 400
+    f = request.files['file']
+    if not f.filename:
+        return jsonify({'success': False, 'error': 'Archivo vacío'}), 400
+
     try:
-        if 'file' not in request.files:
-            return jsonify({'success': False, 'error': 'Envíe un archivo en el campo "file"'}), 400
-        f = request.files['file']
-        if not f.filename:
-            return jsonify({'success': False, 'error': 'Archivo vacío'}), 400
-
-        df = pd.read_csv(f)
-
-        # Normalizar nombres y mapear columnas
-        cols = {c.lower().strip(): c for c in df.columns}
-        date_col = next((cols[k] for k in cols if k in ('date', 'fecha', 'dia', 'fecha_hora')), None)
-        no2_col = next((cols[k] for k in cols if k in ('no2',)), None)
-        hch_col = next((cols[k] for k in cols if k in ('hch', 'hcho', 'formaldehido', 'formaldehído', 'formaldehyde')), None)
-        if not date_col or not no2_col or not hch_col:
-            return jsonify({'success': False, 'error': 'Se requieren columnas: date, no2, hch (o equivalentes)'}), 400
-
-        df = df[[date_col, no2_col, hch_col]].copy()
-        df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-        df[no2_col] = pd.to_numeric(df[no2_col], errors='coerce')
-        df[hch_col] = pd.to_numeric(df[hch_col], errors='coerce')
-        df = df.dropna().sort_values(by=date_col)
-
-        data = [{
-            'date': d.strftime('%Y-%m-%d'),
-            'no2': float(n),
-            'hch': float(h)
-        } for d, n, h in zip(df[date_col], df[no2_col], df[hch_col])]
-
-        timeseries_store['data'] = data
-        return jsonify({'success': True, 'count': len(data), 'data': data})
+        os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        path = os.path.join(UPLOAD_SPOOL_DIR, f'{job_id}.csv')
+        f.save(path)
+        store.create_job(job_id, f.filename, os.path.getsize(path))
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 400
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    threading.Thread(target=_run_upload_job, args=(job_id, path, mode), daemon=True).start()
+    return jsonify({'success': True, 'job': job_id,
+                    'status_url': url_for('api_upload_status', job_id=job_id)}), 202
+
+
+@app.route('/api/upload_timeseries/<job_id>', methods=['GET'])
+def api_upload_status(job_id):
+    """Avance de un trabajo de subida: estado, bytes y filas leídas y resumen al terminar"""
+    job = store.get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Trabajo no encontrado'}), 404
+    return jsonify({'success': True, 'job': job})
+
+
+def _run_upload_job(job_id, path, mode):
+    """Procesa por bloques un CSV subido y guarda sus correcciones en el almacén compartido"""
+    try:
+        store.update_job(job_id, status='running')
+        result = load_upload_partials(
+            path, UPLOAD_CHUNK_SIZE,
+            progress=lambda bytes_read, rows: store.update_job(job_id, bytes_read=bytes_read, rows_read=rows))
+        store.upsert_overrides(result['partials'], mode)
+        store.update_job(job_id, status='done', rows_read=result['rows'], rows_valid=result['valid_rows'],
+                         bytes_read=os.path.getsize(path), summary=partials_summary(result['partials']))
+    except Exception as e:
+        store.update_job(job_id, status='error', error=str(e))
+        return
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    # Este proceso publica de inmediato la serie corregida; los demás la
+    # reconstruyen en segundo plano al ver la nueva versión. Las correcciones
+    # ya están guardadas: un fallo aquí no cambia el estado del trabajo
+    try:
+        series.refresh()
+    except Exception as e:
+        print(f"Error al publicar la serie corregida: {e}")
 
 
 @app.route('/api/timeseries', methods=['GET'])
 def api_timeseries():
-    """Devuelve la serie histórica combinada de archivos locales (NO2 + HCHO)."""
-    data = load_local_timeseries()
-    if data:
-        timeseries_store['data'] = data
-    return jsonify({'success': True, 'data': timeseries_store['data']})
+    """
+    Devuelve la serie histórica combinada de archivos locales (un CSV por
+    contaminante registrado: NO2, HCHO, O3, aerosoles...) con las
+    correcciones diarias subidas aplicadas (salvo en agg=hour y por región).
+    Parámetros opcionales: start y end (YYYY-MM-DD) para recortar el rango,
+    max_points para reducir la serie conservando su forma (LTTB), agg
+    (hour/day/week/month) para elegir el nivel de agregación y stats=1 para
+    incluir mínimo, máximo y conteo de cada periodo. Con format=columnar
+    devuelve {'date': [...], 'no2': [...], 'hch': [...]} y, con
+    encoding=float32, los valores como base64 de un Float32Array.
+    bbox=min_lon,min_lat,max_lon,max_lat o region=<nombre> limitan la serie
+    a una zona usando los agregados por celda de la rejilla espacial.
+    """
+    try:
+        start = request.args.get('start') or None
+        end = request.args.get('end') or None
+        # Fechas normalizadas para la clave de caché ('2024-1-5' = '2024-01-05')
+        start_key = pd.Timestamp(start).isoformat() if start else None
+        end_key = pd.Timestamp(end).isoformat() if end else None
+        max_points = request.args.get('max_points')
+        max_points = int(max_points) if max_points else None
+        if max_points is not None and max_points < 1:
+            raise ValueError('max_points debe ser positivo')
+        agg = request.args.get('agg', 'day')
+        if agg not in ROLLUP_LEVELS:
+            raise ValueError(f'agg debe ser uno de {", ".join(ROLLUP_LEVELS)}')
+        stats = request.args.get('stats', '0').lower() in ('1', 'true', 'yes')
+        fmt, encoding = _response_format()
+        bbox = None
+        if request.args.get('bbox'):
+            bbox = parse_bbox(request.args['bbox'])
+        elif request.args.get('region'):
+            region = request.args['region'].lower()
+            if region not in REGIONS:
+                raise ValueError(f'region debe ser una de {", ".join(REGIONS)}')
+            bbox = REGIONS[region]
+        if bbox is not None and agg == 'hour':
+            raise ValueError('agg=hour no está disponible con bbox o region')
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'Parámetros inválidos: {e}'}), 400
+
+    snapshot = series.get()
+    # La clave sale de los parámetros ya validados: los que no se usan (p. ej.
+    # un parámetro anti-caché) o distintas formas del mismo valor (region y
+    # su bbox) comparten ETag y cuerpo en memoria
+    params_key = (agg, start_key, end_key, max_points, stats, fmt, encoding, bbox)
+    etag = hashlib.sha1(repr((snapshot['version'], params_key)).encode()).hexdigest()
+
+    def build_payload():
+        if bbox is not None:
+            arrays = series.query_region(bbox, start, end, max_points, agg, snapshot)
+        else:
+            arrays = query_series(snapshot['levels'][agg], start, end, max_points)
+        columns = [c for c in arrays if c != 'date'] if stats else None
+        date_unit = LEVEL_DATE_UNITS[agg]
+        if fmt == 'columnar':
+            data = arrays_to_columnar(arrays, columns, date_unit, encoding)
+        else:
+            data = arrays_to_records(arrays, columns, date_unit)
+        return {'success': True, 'agg': agg, 'format': fmt, 'data': data}
+
+    return _cached_json_response(etag, build_payload)
+
+
+def _cached_json_response(etag, build_payload):
+    """
+    Sirve un cuerpo JSON serializado una sola vez por ETag y guardado en
+    memoria junto con sus versiones gzip (y brotli si está instalado). El
+    ETag enviado lleva la codificación elegida: cada codificación es un
+    cuerpo distinto y un validador fuerte no puede repetirse entre ellas.
+    """
+    encodings = ['br', 'gzip', 'identity'] if brotli is not None else ['gzip', 'identity']
+    encoding = request.accept_encodings.best_match(encodings, default='identity')
+    tag = f'{etag}-{encoding}'
+    if request.if_none_match.contains(tag):
+        response = Response(status=304)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        response.set_etag(tag)
+        return response
+
+    with _response_cache_lock:
+        bodies = _response_cache.get(etag)
+        if bodies is not None:
+            _response_cache.move_to_end(etag)
+    if bodies is None:
+        body = app.json.dumps(build_payload()).encode('utf-8')
+        bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=6)}
+        if brotli is not None:
+            bodies['br'] = brotli.compress(body)
+        with _response_cache_lock:
+            _response_cache[etag] = bodies
+            while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                _response_cache.popitem(last=False)
+
+    response = Response(bodies[encoding], mimetype='application/json')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(tag)
+    return response
 
 if __name__ == '__main__':
     # Crear directorio de templates si no existe
     os.makedirs('templates', exist_ok=True)
     # Pre-cargar datos locales si están disponibles
-    timeseries_store['data'] = load_local_timeseries()
+    series.get()
     
     print("🚀 Iniciando servidor web...")
     print("📝 Formulario disponible en: http://localhost:5000")